@@ -0,0 +1,211 @@
+'''
+Static asset pipeline.
+
+The build step copies every file under static/ to static/dist/ under a
+name holding a hash of its contents, e.g. styles.3b1f0c9a2d.css, along
+with gzip and, if the brotli package is installed, brotli compressed
+variants of the text files. A manifest maps the original names to the
+hashed ones. Run it whenever a static file changes:
+
+    python3 assets.py
+
+The app serves the hashed files from /assets/, precompressed to suit the
+Accept-Encoding of the request, and lets clients cache them for a year:
+a changed file gets a new name. The url_for() of the templates points
+url_for('static', filename=...) at the hashed file when the manifest has
+it, and at the plain static file otherwise.
+'''
+from flask import request, send_from_directory, url_for
+import config
+import gzip
+import hashlib
+import io
+import json
+import mimetypes
+import os
+import re
+import shutil
+import sys
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'static')
+DIST_DIR = os.path.join(STATIC_DIR, 'dist')
+MANIFEST = 'manifest.json'
+# URL prefix the hashed files are served under
+ASSET_URL_PATH = '/assets'
+# file types worth compressing; images are compressed already
+COMPRESSIBLE = frozenset(['.css', '.js', '.svg', '.json', '.txt', '.html'])
+# hex digits of the content hash in the file names
+HASH_LENGTH = 10
+# (Accept-Encoding name, variant file suffix), best first
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+_CSS_STATIC_URL = re.compile(
+    r'''url\((['"]?)/static/([^'")]+)\1\)''')
+
+
+def _hashed_name(name, content):
+    '''
+    Utility method: the file name for a content, e.g.
+    styles.3b1f0c9a2d.css for styles.css.
+    '''
+    digest = hashlib.sha256(content).hexdigest()[:HASH_LENGTH]
+    root, ext = os.path.splitext(name)
+    return '{}.{}{}'.format(root, digest, ext)
+
+
+def _write(path, content):
+    with open(path, 'wb') as f:
+        f.write(content)
+
+
+def _compress(path, content):
+    '''
+    Utility method: write the compressed variants of a file, the ones
+    that come out smaller than the file.
+    '''
+    buf = io.BytesIO()
+    # no timestamp, so that a rebuild writes the same bytes
+    with gzip.GzipFile(filename='', mode='wb', compresslevel=9,
+                       fileobj=buf, mtime=0) as f:
+        f.write(content)
+    variants = [('.gz', buf.getvalue())]
+    if brotli is not None:
+        variants.append(('.br', brotli.compress(content)))
+    for suffix, compressed in variants:
+        if len(compressed) < len(content):
+            _write(path + suffix, compressed)
+
+
+def build(static_dir=STATIC_DIR, dist_dir=DIST_DIR):
+    '''
+    Fingerprint and precompress the static files.
+    Stylesheets are built last, with their url(/static/...) references
+    pointed at the hashed files. The previous build is replaced.
+
+    @param static_dir: the directory of the static files
+    @param dist_dir: the directory to build into
+    :returns: the manifest, dict of original name to hashed name
+    '''
+    names = []
+    for root, dirs, files in os.walk(static_dir):
+        dirs[:] = [d for d in dirs
+                   if os.path.join(root, d) != os.path.abspath(dist_dir)]
+        for f in files:
+            names.append(os.path.relpath(os.path.join(root, f), static_dir)
+                         .replace(os.sep, '/'))
+    # stylesheets refer to the other files, so they come after them
+    names.sort(key=lambda name: (name.endswith('.css'), name))
+
+    if os.path.isdir(dist_dir):
+        shutil.rmtree(dist_dir)
+    os.makedirs(dist_dir)
+
+    manifest = {}
+    for name in names:
+        with open(os.path.join(static_dir, name), 'rb') as f:
+            content = f.read()
+        if name.endswith('.css'):
+            content = _CSS_STATIC_URL.sub(
+                lambda m: 'url({0}{1}/{2}{0})'.format(
+                    m.group(1), ASSET_URL_PATH,
+                    manifest.get(m.group(2), m.group(2))),
+                content.decode('utf-8')).encode('utf-8')
+        hashed = _hashed_name(name, content)
+        path = os.path.join(dist_dir, hashed)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        _write(path, content)
+        if os.path.splitext(name)[1] in COMPRESSIBLE:
+            _compress(path, content)
+        manifest[name] = hashed
+
+    with open(os.path.join(dist_dir, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+def load_manifest(dist_dir=DIST_DIR):
+    '''
+    Read the manifest of the last build.
+
+    @param dist_dir: the directory built into
+    :returns: dict of original name to hashed name, empty if there was
+        no build
+    '''
+    try:
+        with open(os.path.join(dist_dir, MANIFEST)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def init_app(app, settings=config, dist_dir=DIST_DIR):
+    '''
+    Serve the built assets and point the templates' url_for() at them.
+
+    @param app: the Flask app
+    @param settings: object holding the settings, see config.py
+    @param dist_dir: the directory built into
+    '''
+    manifest = load_manifest(dist_dir)
+    max_age = settings.ASSET_MAX_AGE
+
+    def send_asset(filename):
+        '''
+        Send a hashed file, precompressed if the client accepts one of
+        the encodings and the variant exists.
+        '''
+        encoding, suffix = None, ''
+        for name, variant in ENCODINGS:
+            if request.accept_encodings[name] and os.path.isfile(
+                    os.path.join(dist_dir, filename + variant)):
+                encoding, suffix = name, variant
+                break
+        response = send_from_directory(
+            dist_dir, filename + suffix,
+            mimetype=mimetypes.guess_type(filename)[0] or
+            'application/octet-stream',
+            cache_timeout=max_age)
+        if encoding is not None:
+            response.headers['Content-Encoding'] = encoding
+        response.vary.add('Accept-Encoding')
+        response.headers['Cache-Control'] = \
+            'public, max-age={}, immutable'.format(max_age)
+        return response
+
+    app.add_url_rule(ASSET_URL_PATH + '/<path:filename>', 'asset',
+                     send_asset)
+
+    def asset_url_for(endpoint, **values):
+        '''
+        url_for() for the templates, sending static files to their
+        hashed names.
+        '''
+        if endpoint == 'static':
+            hashed = manifest.get(values.get('filename'))
+            if hashed is not None:
+                endpoint = 'asset'
+                values['filename'] = hashed
+        return url_for(endpoint, **values)
+
+    @app.context_processor
+    def inject_url_for():
+        return {'url_for': asset_url_for}
+
+
+def main():
+    manifest = build()
+    sys.stdout.write('Built {} assets into {}{}\n'.format(
+        len(manifest), DIST_DIR,
+        '' if brotli is not None else ' (no brotli: pip3 install brotli)'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,850 @@
+'''
+HTTP benchmark suite.
+
+Drives every route of server.py through the Flask test client, at a
+fixed concurrency, against a scratch DB, and reports latency percentiles,
+throughput, and SQL queries and pool checkouts per request. Usage:
+
+    python3 bench.py --generate --teams 100 --players-per-team 25
+    python3 bench.py --save bench_baseline.json
+    python3 bench.py --compare bench_baseline.json
+
+--generate (re)builds the scratch DB with league_gen.py first. --save
+writes the results to a JSON file, and --compare reports the changes
+against such a file and flags the regressions.
+
+--read-paths instead compares reading players through ORM entities,
+ORM column tuples, Core rows and Core records, in time and memory per
+row, e.g. at 100k rows:
+
+    python3 bench.py --generate --teams 1100 --players-per-team 99 \\
+        --read-paths --read-rows 100000
+
+--compression instead reports the bytes on the wire and the CPU time of
+compressing catalog.json pages of several sizes, and the whole catalog,
+at several gzip and brotli levels:
+
+    python3 bench.py --generate --teams 1000 --players-per-team 25 \\
+        --compression --compression-rows 100 1000 5000 0
+
+--catalog-scaling instead times catalog.build_catalog() on synthetic
+catalogs of several sizes, and fails unless the time per row stays
+within SCALING_TOLERANCE of the smallest, i.e. grows linearly:
+
+    python3 bench.py --catalog-scaling --scaling-rows 10000 40000 160000
+
+--jersey-race instead has concurrent writers add a player with the same
+jersey number to the scratch team at once, and fails unless exactly one
+gets it and the others are told it is taken:
+
+    python3 bench.py --jersey-race --race-writers 16
+    python3 bench.py --jersey-race --race-endpoint batch
+'''
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import argparse
+import gc
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+
+
+BENCH_TEAM = ('Bench Scratch', 'benchscratch')
+# the jersey number --jersey-race writers fight over
+RACE_JERSEY_NUMBER = 42
+# prefix, multi-term and misspelled queries
+SEARCH_QUERIES = ('ell', 'goal', 'def ell', 'ellis', 'elis', 'pred')
+USER_SESSION = {
+    'state': 'bench',
+    'username': 'Bench User',
+    'email': 'bench@example.com'
+}
+
+
+class Scenario(object):
+    '''
+    A named batch of requests to one route.
+    '''
+
+    def __init__(self, name, build, login=False, limit=None, expect=None):
+        '''
+        @param name: the name the results are reported under
+        @param build: callable taking the bench context and the number of
+            requests, returning a list of (method, url, form data) tuples;
+            called right before the scenario runs
+        @param login: send the requests as a logged-in user
+        @param limit: upper bound on the number of requests
+        @param expect: the status code every request must get, or None
+            to count only server errors as errors; set it for writes,
+            whose rejected requests take a cheaper path
+        '''
+        self.name = name
+        self.build = build
+        self.login = login
+        self.limit = limit
+        self.expect = expect
+
+
+def _get(url_fn):
+    return lambda context, count: [
+        ('GET', url_fn(context, i), None) for i in range(count)]
+
+
+def _scratch_players(context):
+    '''
+    Utility method: the (id, jersey number) of the scratch team players.
+    '''
+    from db_setup import Player
+    from database import db_session
+    with context['app'].app_context():
+        return db_session.query(Player.id, Player.jersey_number).filter_by(
+            team_id=context['scratch_team_id']).order_by(Player.id).all()
+
+
+SCENARIOS = [
+    Scenario('show_teams', _get(lambda c, i: '/teams/')),
+    Scenario('show_players', _get(
+        lambda c, i: '/teams/{}/players/'.format(
+            c['nicknames'][i % len(c['nicknames'])]))),
+    Scenario('show_player', _get(
+        lambda c, i: '/teams/{}/players/{}'.format(
+            *c['players'][i % len(c['players'])]))),
+    Scenario('get_catalog_json', _get(
+        lambda c, i: '/api/v1/catalog.json'), limit=20),
+    Scenario('get_catalog_json_stream', _get(
+        lambda c, i: '/api/v1/catalog.json?stream=1'), limit=20),
+    Scenario('get_catalog_json_page', _get(
+        lambda c, i: '/api/v1/catalog.json?limit=500')),
+    Scenario('get_catalog_msgpack', _get(
+        lambda c, i: '/api/v1/catalog.json?format=msgpack'), limit=20),
+    Scenario('get_catalog_ndjson', _get(
+        lambda c, i: '/api/v1/catalog.json?format=ndjson'), limit=20),
+    Scenario('get_catalog_csv', _get(
+        lambda c, i: '/api/v1/catalog.json?format=csv'), limit=20),
+    Scenario('get_team_players_json', _get(
+        lambda c, i: '/api/v1/teams/{}/players?limit=50'.format(
+            c['nicknames'][i % len(c['nicknames'])]))),
+    Scenario('get_player_json', _get(
+        lambda c, i: '/api/v1/players/{}?fields=name,jersey_number'.format(
+            c['players'][i % len(c['players'])][1]))),
+    Scenario('get_search_json', _get(
+        lambda c, i: '/api/v1/search?q={}'.format(
+            SEARCH_QUERIES[i % len(SEARCH_QUERIES)]))),
+    Scenario('show_login', _get(lambda c, i: '/login')),
+    Scenario('add_player_form', _get(
+        lambda c, i: '/teams/{}/players/new/'.format(BENCH_TEAM[1])),
+        login=True),
+    # one new player per free jersey number of the scratch team
+    Scenario('add_player', lambda c, count: [
+        ('POST', '/teams/{}/players/new/'.format(BENCH_TEAM[1]), {
+            'name': 'Bench Player {}'.format(n),
+            'jersey_number': str(n),
+            'position': 'Offenceman'
+        }) for n in range(1, count + 1)
+    ], login=True, limit=99, expect=302),
+    # players keep their numbers, which are bound to be free
+    Scenario('edit_player', lambda c, count: [
+        ('POST', '/teams/{}/players/{}/edit'.format(BENCH_TEAM[1], p), {
+            'name': 'Edited Player {}'.format(p),
+            'jersey_number': str(n),
+            'position': 'Defenceman'
+        }) for p, n in _scratch_players(c)[:count]
+    ], login=True, expect=302),
+    Scenario('delete_player', lambda c, count: [
+        ('POST', '/teams/{}/players/{}/delete/'.format(BENCH_TEAM[1], p),
+         None) for p, _ in _scratch_players(c)[:count]
+    ], login=True, expect=302),
+    Scenario('gconnect_bad_state', lambda c, count: [
+        ('POST', '/gconnect?state=wrong', None)] * count, expect=401),
+    Scenario('disconnect', _get(lambda c, i: '/disconnect')),
+]
+
+
+class QueryCounter(object):
+    '''
+    Counts the SQL statements and pool checkouts of the calling thread.
+    '''
+
+    def __init__(self, engine):
+        from sqlalchemy import event
+        self._local = threading.local()
+        event.listen(engine, 'before_cursor_execute', self._on_query)
+        event.listen(engine, 'checkout', self._on_checkout)
+
+    def read(self):
+        return (getattr(self._local, 'queries', 0),
+                getattr(self._local, 'checkouts', 0))
+
+    def _on_query(self, *args):
+        self._local.queries = getattr(self._local, 'queries', 0) + 1
+
+    def _on_checkout(self, *args):
+        self._local.checkouts = getattr(self._local, 'checkouts', 0) + 1
+
+
+def percentile(samples, pct):
+    '''
+    Nearest-rank percentile.
+
+    @param samples: sorted list of samples
+    @param pct: the percentile, 0-100
+    :returns: the percentile, or None if there are no samples
+    '''
+    if not samples:
+        return None
+    rank = max(int(round(pct / 100.0 * len(samples) + 0.5)), 1)
+    return samples[min(rank, len(samples)) - 1]
+
+
+def setup_context(app):
+    '''
+    Make sure the scratch team and bench user exist, and collect the
+    teams and players to request.
+
+    @param app: the Flask app
+    :returns: the bench context dict
+    '''
+    from db_setup import User, Team, Player
+    from database import db_session
+
+    with app.app_context():
+        user = db_session.query(User).filter_by(
+            email=USER_SESSION['email']).one_or_none()
+        if user is None:
+            user = User(name=USER_SESSION['username'],
+                        email=USER_SESSION['email'])
+            db_session.add(user)
+        team = db_session.query(Team).filter_by(
+            nickname=BENCH_TEAM[1]).one_or_none()
+        if team is None:
+            team = Team(name=BENCH_TEAM[0], nickname=BENCH_TEAM[1])
+            db_session.add(team)
+        db_session.commit()
+        # leftovers of an interrupted run
+        db_session.query(Player).filter_by(team_id=team.id).delete()
+        db_session.commit()
+
+        nicknames = [n for (n,) in db_session.query(Team.nickname).filter(
+            Team.id != team.id).order_by(Team.id)]
+        players = db_session.query(Team.nickname, Player.id).join(
+            Player, Player.team_id == Team.id).order_by(
+            Player.id).limit(1000).all()
+
+        return {
+            'app': app,
+            'user_id': user.id,
+            'scratch_team_id': team.id,
+            'nicknames': nicknames or [BENCH_TEAM[1]],
+            'players': players or [(BENCH_TEAM[1], 0)]
+        }
+
+
+def _client(context, login=False):
+    '''
+    Utility method: a test client with a session, logged in as the bench
+    user if login.
+    '''
+    client = context['app'].test_client()
+    with client.session_transaction() as s:
+        s['state'] = USER_SESSION['state']
+        if login:
+            s['username'] = USER_SESSION['username']
+            s['email'] = USER_SESSION['email']
+            s['user_id'] = context['user_id']
+    return client
+
+
+def run_scenario(context, counter, scenario, requests, concurrency):
+    '''
+    Send a scenario's requests from concurrent test clients.
+
+    @param context: the bench context
+    @param counter: the QueryCounter of the app's engine
+    @param scenario: the Scenario to run
+    @param requests: number of requests, before the scenario's limit
+    @param concurrency: number of concurrent clients
+    :returns: dict of results
+    '''
+    app = context['app']
+    if scenario.limit is not None:
+        requests = min(requests, scenario.limit)
+    calls = scenario.build(context, requests)
+    if not calls:
+        return None
+
+    def worker(share):
+        client = _client(context, scenario.login)
+        samples = []
+        for method, url, data in share:
+            q0, c0 = counter.read()
+            started = time.perf_counter()
+            response = client.open(url, method=method, data=data)
+            response.get_data()
+            elapsed = time.perf_counter() - started
+            q1, c1 = counter.read()
+            samples.append((elapsed, q1 - q0, c1 - c0,
+                            response.status_code, len(response.data)))
+        return samples
+
+    shares = [calls[i::concurrency] for i in range(concurrency)]
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        samples = [s for share in pool.map(worker, shares) for s in share]
+    wall = time.perf_counter() - started
+
+    latencies = sorted(s[0] * 1000 for s in samples)
+    return {
+        'requests': len(samples),
+        'errors': sum(1 for s in samples if s[3] >= 500 or (
+            scenario.expect is not None and s[3] != scenario.expect)),
+        'p50_ms': percentile(latencies, 50),
+        'p95_ms': percentile(latencies, 95),
+        'p99_ms': percentile(latencies, 99),
+        'throughput_rps': len(samples) / wall,
+        'queries_per_request': sum(s[1] for s in samples) / len(samples),
+        'checkouts_per_request': sum(s[2] for s in samples) / len(samples),
+        'bytes_per_response': sum(s[4] for s in samples) / len(samples)
+    }
+
+
+def _race_form(client, n):
+    '''
+    Utility method: add the race player through the new player form.
+    :returns: 'added', 'taken' or 'other'
+    '''
+    response = client.post(
+        '/teams/{}/players/new/'.format(BENCH_TEAM[1]), data={
+            'name': 'Race Player {}'.format(n),
+            'jersey_number': str(RACE_JERSEY_NUMBER),
+            'position': 'Offenceman'
+        })
+    if response.status_code == 302:
+        return 'added'
+    if response.status_code == 200 and \
+            b'is already taken' in response.get_data():
+        return 'taken'
+    return 'other'
+
+
+def _race_batch(client, n):
+    '''
+    Utility method: add the race player through the batch API. A 400 is
+    the batch validation seeing the number taken; a 409 is the unique
+    index catching a writer that got past the validation.
+    :returns: 'added', 'taken', 'taken_at_commit' or 'other'
+    '''
+    response = client.post('/api/v1/players/batch', json={'operations': [{
+        'op': 'create',
+        'team': BENCH_TEAM[1],
+        'name': 'Race Player {}'.format(n),
+        'jersey_number': RACE_JERSEY_NUMBER,
+        'position': 'Offenceman'
+    }]})
+    if response.status_code == 200:
+        return 'added'
+    if response.status_code == 400 and \
+            b'already taken' in response.get_data():
+        return 'taken'
+    if response.status_code == 409:
+        return 'taken_at_commit'
+    return 'other'
+
+
+# endpoint name: function racing through it, see race_jersey_number()
+RACE_ENDPOINTS = {
+    'form': _race_form,
+    'batch': _race_batch
+}
+
+
+def race_jersey_number(context, writers, endpoint='form'):
+    '''
+    Have concurrent writers add a player wearing RACE_JERSEY_NUMBER to
+    the scratch team, all at once.
+
+    @param context: the bench context
+    @param writers: number of concurrent writers
+    @param endpoint: the endpoint they add it through, a key of
+        RACE_ENDPOINTS
+    :returns: dict with the number of players added, of responses saying
+        the number is taken, of those caught by the unique index at
+        commit (batch only), of other responses, and of players wearing
+        the number once done
+    '''
+    from db_setup import Player
+    from database import db_session
+    race = RACE_ENDPOINTS[endpoint]
+    start = threading.Barrier(writers)
+
+    def writer(n):
+        client = _client(context, login=True)
+        start.wait()
+        return race(client, n)
+
+    with ThreadPoolExecutor(max_workers=writers) as pool:
+        outcomes = list(pool.map(writer, range(writers)))
+    with context['app'].app_context():
+        rows = db_session.query(Player).filter_by(
+            team_id=context['scratch_team_id'],
+            jersey_number=RACE_JERSEY_NUMBER).count()
+
+    return {
+        'writers': writers,
+        'added': outcomes.count('added'),
+        'taken': outcomes.count('taken') + outcomes.count('taken_at_commit'),
+        'taken_at_commit': outcomes.count('taken_at_commit'),
+        'other': outcomes.count('other'),
+        'rows': rows
+    }
+
+
+def race_won_once(result):
+    '''
+    Tell if exactly one writer of race_jersey_number() got the number,
+    and the others were told it is taken.
+    '''
+    return result['rows'] == 1 and result['added'] == 1 and \
+        result['taken'] == result['writers'] - 1
+
+
+def _read_orm_entities(session, rows):
+    from db_setup import Player
+    return session.query(Player).order_by(Player.id).limit(rows).all()
+
+
+def _read_orm_columns(session, rows):
+    from db_setup import Player
+    return session.query(
+        Player.id, Player.name, Player.jersey_number, Player.position,
+        Player.team_id, Player.user_id
+    ).order_by(Player.id).limit(rows).all()
+
+
+def _read_core_rows(session, rows):
+    from sqlalchemy import select
+    from records import PLAYER_COLUMNS
+    return session.execute(select(PLAYER_COLUMNS).order_by(
+        PLAYER_COLUMNS[0]).limit(rows)).fetchall()
+
+
+def _read_core_records(session, rows):
+    from sqlalchemy import select
+    from records import PlayerRecord, PLAYER_COLUMNS
+    return [PlayerRecord(*row) for row in session.execute(
+        select(PLAYER_COLUMNS).order_by(PLAYER_COLUMNS[0]).limit(rows))]
+
+
+# (name, read function) of the read paths compared by --read-paths
+READ_PATHS = [
+    ('orm_entities', _read_orm_entities),
+    ('orm_columns', _read_orm_columns),
+    ('core_rows', _read_core_rows),
+    ('core_records', _read_core_records),
+]
+
+
+def bench_read_paths(engine, rows, repeat=3):
+    '''
+    Read the same players through each of the READ_PATHS.
+    Time is the best of repeat runs, memory is what tracemalloc sees
+    allocated while the rows, and the session that loaded them, are
+    still alive: at peak and once the read is done.
+
+    @param engine: the DB engine
+    @param rows: number of players to read
+    @param repeat: number of timed runs per read path
+    :returns: dict of results, by read path
+    '''
+    from sqlalchemy.orm import sessionmaker
+    Session = sessionmaker(bind=engine)
+
+    results = {}
+    for name, read in READ_PATHS:
+        read(Session(), 1)  # warm up the statement caches
+        timings = []
+        for _ in range(repeat):
+            session = Session()
+            gc.collect()
+            started = time.perf_counter()
+            loaded = read(session, rows)
+            timings.append(time.perf_counter() - started)
+            session.close()
+            del loaded
+
+        session = Session()
+        gc.collect()
+        tracemalloc.start()
+        loaded = read(session, rows)
+        held, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        count = len(loaded)
+        session.close()
+        del loaded
+
+        best = min(timings)
+        results[name] = {
+            'rows': count,
+            'best_ms': best * 1000,
+            'us_per_row': best * 1e6 / max(count, 1),
+            'bytes_per_row': held / max(count, 1),
+            'peak_bytes_per_row': peak / max(count, 1)
+        }
+    return results
+
+
+def print_read_paths(results, out=sys.stdout):
+    out.write('{:<16}{:>9}{:>11}{:>9}{:>10}{:>12}\n'.format(
+        'read path', 'rows', 'best ms', 'us/row', 'B/row', 'peak B/row'))
+    for name, r in results.items():
+        out.write('{:<16}{:>9}{:>11.1f}{:>9.2f}{:>10.0f}{:>12.0f}\n'.format(
+            name, r['rows'], r['best_ms'], r['us_per_row'],
+            r['bytes_per_row'], r['peak_bytes_per_row']))
+
+
+# how much the time per row of --catalog-scaling may grow with the size
+SCALING_TOLERANCE = 2.0
+
+
+def _synthetic_catalog_rows(players, players_per_team):
+    '''
+    Utility method: rows shaped like catalog_rows() returns them, for a
+    league of players_per_team players per team.
+    '''
+    return [(p // players_per_team + 1,
+             'Team {:06d}'.format(p // players_per_team + 1),
+             'team{:06d}'.format(p // players_per_team + 1),
+             p + 1,
+             'Player {:06d}'.format(p + 1),
+             p % players_per_team + 1,
+             'Offenceman') for p in range(players)]
+
+
+def bench_catalog_scaling(sizes, players_per_team=25, repeat=3):
+    '''
+    Time build_catalog() on catalogs of several sizes, the number of
+    teams growing with the number of players. The time is the best of
+    repeat runs, with the garbage collector off, as timeit does.
+
+    @param sizes: numbers of players
+    @param players_per_team: players per team
+    @param repeat: number of timed runs per size
+    :returns: list of results, by size
+    '''
+    from catalog import build_catalog
+    results = []
+    for players in sizes:
+        rows = _synthetic_catalog_rows(players, players_per_team)
+        timings = []
+        for _ in range(repeat):
+            gc.collect()
+            gc.disable()
+            try:
+                started = time.perf_counter()
+                catalog = build_catalog(rows)
+                timings.append(time.perf_counter() - started)
+            finally:
+                gc.enable()
+            del catalog
+        best = min(timings)
+        results.append({
+            'rows': players,
+            'teams': -(-players // players_per_team),
+            'best_ms': best * 1000,
+            'us_per_row': best * 1e6 / max(players, 1)
+        })
+    return results
+
+
+def is_linear(results, tolerance=SCALING_TOLERANCE):
+    '''
+    Tell if the time per row of bench_catalog_scaling() results stays
+    within tolerance times the smallest one.
+    '''
+    per_row = [r['us_per_row'] for r in results]
+    return max(per_row) <= tolerance * min(per_row)
+
+
+def print_catalog_scaling(results, out=sys.stdout):
+    out.write('{:>9}{:>8}{:>11}{:>9}\n'.format(
+        'rows', 'teams', 'best ms', 'us/row'))
+    for r in results:
+        out.write('{:>9}{:>8}{:>11.1f}{:>9.2f}\n'.format(
+            r['rows'], r['teams'], r['best_ms'], r['us_per_row']))
+    per_row = [r['us_per_row'] for r in results]
+    out.write('{}: the time per row varies {:.1f}x, {} {:.1f}x\n'.format(
+        'linear' if is_linear(results) else 'NOT LINEAR',
+        max(per_row) / min(per_row),
+        'within' if is_linear(results) else 'more than',
+        SCALING_TOLERANCE))
+
+
+# (encoding, level) pairs compared by --compression
+COMPRESSION_LEVELS = [
+    ('gzip', 1), ('gzip', 6), ('gzip', 9),
+    ('br', 1), ('br', 4), ('br', 11)
+]
+
+
+def bench_compression(app, page_sizes, min_time=0.2):
+    '''
+    Compress catalog.json documents at each of the COMPRESSION_LEVELS.
+    CPU time is per document, averaged over as many runs as fit in
+    min_time.
+
+    @param app: the Flask app
+    @param page_sizes: rows per catalog page to fetch, 0 for the whole
+        catalog, streamed
+    @param min_time: seconds of CPU time to spend per measurement
+    :returns: list of results
+    '''
+    import compression
+    client = app.test_client()
+    results = []
+    for rows in page_sizes:
+        url = '/api/v1/catalog.json?' + (
+            'stream=1' if rows == 0 else 'limit={}'.format(rows))
+        body = client.get(url, headers={'Accept-Encoding': 'identity'}) \
+            .get_data()
+        for encoding, level in COMPRESSION_LEVELS:
+            if encoding not in compression.encodings():
+                continue
+            runs = 0
+            started = time.process_time()
+            while True:
+                compressor = compression.Compressor(encoding, level)
+                size = len(compressor.compress(body) + compressor.finish())
+                runs += 1
+                elapsed = time.process_time() - started
+                if elapsed >= min_time:
+                    break
+            results.append({
+                'rows': rows or 'all',
+                'encoding': encoding,
+                'level': level,
+                'raw_bytes': len(body),
+                'bytes': size,
+                'ratio': size / float(len(body)),
+                'cpu_ms': elapsed * 1000 / runs,
+                'mb_per_s': len(body) * runs / elapsed / 1e6
+            })
+    return results
+
+
+def print_compression(results, out=sys.stdout):
+    out.write('{:>6}{:>7}{:>7}{:>12}{:>11}{:>8}{:>10}{:>9}\n'.format(
+        'rows', 'enc', 'level', 'raw bytes', 'bytes', 'ratio', 'cpu ms',
+        'MB/s'))
+    for r in results:
+        out.write('{:>6}{:>7}{:>7}{:>12}{:>11}{:>8.3f}{:>10.2f}{:>9.1f}\n'
+                  .format(r['rows'], r['encoding'], r['level'],
+                          r['raw_bytes'], r['bytes'], r['ratio'],
+                          r['cpu_ms'], r['mb_per_s']))
+
+
+def print_results(results, out=sys.stdout):
+    out.write('{:<26}{:>6}{:>5}{:>10}{:>10}{:>10}{:>10}{:>9}{:>8}\n'.format(
+        'route', 'n', 'err', 'p50 ms', 'p95 ms', 'p99 ms', 'req/s',
+        'sql/req', 'co/req'))
+    for name, r in results.items():
+        out.write('{:<26}{:>6}{:>5}{:>10.2f}{:>10.2f}{:>10.2f}{:>10.1f}'
+                  '{:>9.1f}{:>8.1f}\n'.format(
+                      name, r['requests'], r['errors'], r['p50_ms'],
+                      r['p95_ms'], r['p99_ms'], r['throughput_rps'],
+                      r['queries_per_request'], r['checkouts_per_request']))
+
+
+def compare_results(baseline, results, threshold, out=sys.stdout):
+    '''
+    Report the changes against a baseline.
+
+    @param baseline: results loaded from a file written by --save
+    @param results: the results of this run
+    @param threshold: relative p95/throughput change counted as a
+        regression, e.g. 0.2 for 20%
+    :returns: the names of the regressed routes
+    '''
+    regressions = []
+    out.write('\nagainst baseline {} ({}):\n'.format(
+        baseline.get('commit') or '?', baseline.get('created')))
+    for name, r in results.items():
+        b = baseline['results'].get(name)
+        if b is None:
+            continue
+        p95 = r['p95_ms'] / b['p95_ms'] - 1 if b['p95_ms'] else 0
+        rps = r['throughput_rps'] / b['throughput_rps'] - 1 \
+            if b['throughput_rps'] else 0
+        sql = r['queries_per_request'] - b['queries_per_request']
+        regressed = p95 > threshold or rps < -threshold or sql > 0.05
+        if regressed:
+            regressions.append(name)
+        out.write('{:<26} p95 {:>+7.1%}  req/s {:>+7.1%}  sql/req {:>+5.1f}'
+                  '{}\n'.format(name, p95, rps, sql,
+                                '  REGRESSION' if regressed else ''))
+    return regressions
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark every route of the catalog app.')
+    parser.add_argument('--database-url', default='sqlite:///bench.db')
+    parser.add_argument('--generate', action='store_true',
+                        help='rebuild the scratch DB with league_gen.py')
+    parser.add_argument('--teams', type=int, default=31)
+    parser.add_argument('--players-per-team', type=int, default=25)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--requests', type=int, default=200,
+                        help='requests per route (default: %(default)s)')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--only', action='append',
+                        help='run only this route; may be repeated')
+    parser.add_argument('--save', help='write the results to this file')
+    parser.add_argument('--compare', help='compare against a saved file')
+    parser.add_argument('--threshold', type=float, default=0.2)
+    parser.add_argument('--read-paths', action='store_true',
+                        help='compare the ORM and Core read paths instead')
+    parser.add_argument('--read-rows', type=int, default=100000,
+                        help='players read per read path '
+                        '(default: %(default)s)')
+    parser.add_argument('--compression', action='store_true',
+                        help='measure response compression instead')
+    parser.add_argument('--compression-rows', type=int, nargs='+',
+                        default=[100, 1000, 5000, 0],
+                        help='rows per catalog page, 0 for the whole '
+                        'catalog (default: %(default)s)')
+    parser.add_argument('--catalog-scaling', action='store_true',
+                        help='check that building the catalog scales '
+                        'linearly instead')
+    parser.add_argument('--scaling-rows', type=int, nargs='+',
+                        default=[10000, 40000, 160000],
+                        help='players per catalog (default: %(default)s)')
+    parser.add_argument('--jersey-race', action='store_true',
+                        help='check that concurrent writers never share '
+                        'a jersey number instead')
+    parser.add_argument('--race-writers', type=int, default=16,
+                        help='concurrent writers (default: %(default)s)')
+    parser.add_argument('--race-endpoint', choices=sorted(RACE_ENDPOINTS),
+                        default='form',
+                        help='endpoint the writers add the player through '
+                        '(default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    if args.catalog_scaling:
+        # no DB needed
+        results = bench_catalog_scaling(args.scaling_rows)
+        print_catalog_scaling(results)
+        return 0 if is_linear(results) else 1
+
+    # config.py reads the environment at import time
+    os.environ['CATALOG_DATABASE_URL'] = args.database_url
+    if args.generate and args.database_url.startswith('sqlite:///'):
+        path = args.database_url[len('sqlite:///'):]
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+    import database
+    import league_gen
+    engine = database.get_engine()
+    database.create_schema()
+    if args.generate:
+        league_gen.generate(engine, args.teams, args.players_per_team,
+                            args.users, args.seed)
+
+    if args.read_paths:
+        results = bench_read_paths(engine, args.read_rows)
+        print_read_paths(results)
+        if args.save:
+            with open(args.save, 'w') as f:
+                json.dump({
+                    'created': datetime.utcnow().isoformat(),
+                    'commit': git_commit(),
+                    'settings': {
+                        'database_url': args.database_url,
+                        'read_rows': args.read_rows
+                    },
+                    'read_paths': results
+                }, f, indent=2, sort_keys=True)
+        return 0
+
+    import server
+
+    app = server.create_app()
+    app.secret_key = 'bench'
+    if args.compression:
+        results = bench_compression(app, args.compression_rows)
+        print_compression(results)
+        if args.save:
+            with open(args.save, 'w') as f:
+                json.dump({
+                    'created': datetime.utcnow().isoformat(),
+                    'commit': git_commit(),
+                    'settings': {
+                        'database_url': args.database_url,
+                        'compression_rows': args.compression_rows
+                    },
+                    'compression': results
+                }, f, indent=2, sort_keys=True)
+        return 0
+
+    counter = QueryCounter(engine)
+    context = setup_context(app)
+
+    if args.jersey_race:
+        result = race_jersey_number(context, args.race_writers,
+                                    args.race_endpoint)
+        won_once = race_won_once(result)
+        print('{}: {writers} writers, {added} added, {taken} told taken '
+              '({taken_at_commit} at commit), {other} other responses, '
+              '{rows} player(s) wearing {}'.format(
+                  'ok' if won_once else 'FAILED', RACE_JERSEY_NUMBER,
+                  **result))
+        return 0 if won_once else 1
+
+    results = {}
+    for scenario in SCENARIOS:
+        if args.only and scenario.name not in args.only:
+            continue
+        result = run_scenario(context, counter, scenario,
+                              args.requests, args.concurrency)
+        if result is not None:
+            results[scenario.name] = result
+    print_results(results)
+
+    regressions = []
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare_results(
+                json.load(f), results, args.threshold)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({
+                'created': datetime.utcnow().isoformat(),
+                'commit': git_commit(),
+                'settings': {
+                    'database_url': args.database_url,
+                    'requests': args.requests,
+                    'concurrency': args.concurrency
+                },
+                'results': results
+            }, f, indent=2, sort_keys=True)
+
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
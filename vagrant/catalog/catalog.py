@@ -0,0 +1,309 @@
+from sqlalchemy import asc, and_, or_, func, select
+from sqlalchemy.exc import IntegrityError
+from db_setup import CatalogVersion
+from records import PlayerRecord, PLAYER_COLUMNS, team_table, player_table
+from datetime import datetime
+import base64
+import binascii
+import json
+
+
+# number of rows fetched per round-trip when streaming the catalog
+CATALOG_BATCH_SIZE = 1000
+# page size bounds for the cursor-paginated catalog
+CATALOG_PAGE_SIZE = 500
+CATALOG_MAX_PAGE_SIZE = 5000
+# page size bounds for the keyset-paginated team rosters
+ROSTER_PAGE_SIZE = 50
+ROSTER_MAX_PAGE_SIZE = 500
+# the keys of Player.serialize, which sparse fieldsets pick from
+PLAYER_FIELDS = PlayerRecord._fields
+
+
+def catalog_select():
+    '''
+    Core select of the entire catalog as flat (team, player) rows.
+    Teams are outer-joined to their players so that teams without any
+    players still show up, with the player columns set to None.
+    Rows come back ordered by team id, then player id, which lets the
+    callers group them in a single pass.
+
+    :returns: select of (team_id, team_name, team_nickname, player_id,
+        player_name, jersey_number, position) rows
+    '''
+    return select([
+        team_table.c.id,
+        team_table.c.name,
+        team_table.c.nickname,
+        player_table.c.id,
+        player_table.c.name,
+        player_table.c.jersey_number,
+        player_table.c.position
+    ]).select_from(
+        team_table.outerjoin(
+            player_table, player_table.c.team_id == team_table.c.id)
+    ).order_by(
+        asc(team_table.c.id), asc(player_table.c.id)
+    )
+
+
+def catalog_rows(session, stream=False):
+    '''
+    Read the entire catalog as flat (team, player) rows, see
+    catalog_select(). The rows are plain tuples, no ORM objects are built.
+
+    @param session: the DB session to run the select with
+    @param stream: fetch the rows as they are consumed, with a server-side
+        cursor on backends that have them, rather than all at once
+    :returns: result yielding the rows
+    '''
+    statement = catalog_select()
+    if stream:
+        statement = statement.execution_options(stream_results=True)
+    return session.execute(statement)
+
+
+def _player_dict(player_id, player_name, jersey_number, position):
+    '''
+    Utility method: a catalog player entry.
+    '''
+    return {
+        'id': player_id,
+        'name': player_name,
+        'jersery_number': jersey_number,
+        'position': position
+    }
+
+
+def build_catalog(rows):
+    '''
+    Group flat catalog rows into the nested catalog document.
+    Runs in a single pass over rows ordered by team id, so the cost is
+    linear in the number of rows.
+
+    @param rows: iterable of rows as returned by catalog_rows()
+    :returns: dict with the list of teams, each with its players
+    '''
+    catalog = {'teams': []}
+    team = None
+    for (team_id, team_name, team_nickname,
+         player_id, player_name, jersey_number, position) in rows:
+        if team is None or team['id'] != team_id:
+            team = {
+                'id': team_id,
+                'name': team_name,
+                'nickname': team_nickname,
+                'players': []
+            }
+            catalog['teams'].append(team)
+        if player_id is not None:
+            team['players'].append(_player_dict(
+                player_id, player_name, jersey_number, position))
+
+    return catalog
+
+
+def stream_catalog(rows, batch_size=CATALOG_BATCH_SIZE):
+    '''
+    Serialize flat catalog rows into JSON text chunks.
+    The chunks concatenate to the same document build_catalog() would
+    produce, but only one batch of rows is held in memory at a time.
+
+    @param rows: iterable of rows as returned by catalog_rows()
+    @param batch_size: number of rows serialized per yielded chunk
+    :returns: generator of JSON text chunks
+    '''
+    parts = ['{"teams": [']
+    team_id = None
+    first_player = True
+    for count, (t_id, team_name, team_nickname,
+                player_id, player_name, jersey_number,
+                position) in enumerate(rows, 1):
+        if t_id != team_id:
+            if team_id is not None:
+                parts.append(']}, ')
+            parts.append('{{"id": {}, "name": {}, "nickname": {}, '
+                         '"players": ['.format(
+                             json.dumps(t_id),
+                             json.dumps(team_name),
+                             json.dumps(team_nickname)))
+            team_id = t_id
+            first_player = True
+        if player_id is not None:
+            if not first_player:
+                parts.append(', ')
+            parts.append(json.dumps(
+                _player_dict(player_id, player_name, jersey_number, position),
+                sort_keys=True
+            ))
+            first_player = False
+        if count % batch_size == 0:
+            yield ''.join(parts)
+            parts = []
+
+    if team_id is not None:
+        parts.append(']}')
+    parts.append(']}')
+    yield ''.join(parts)
+
+
+def encode_cursor(team_id, player_id):
+    '''
+    Encode a catalog position into an opaque cursor.
+
+    @param team_id: the id of the last team returned
+    @param player_id: the id of the last player returned, or None
+    :returns: the cursor string
+    '''
+    key = '{}:{}'.format(team_id, player_id or 0)
+    return base64.urlsafe_b64encode(key.encode('ascii')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    '''
+    Decode an opaque cursor back into a catalog position.
+
+    @param cursor: the cursor string, as returned by encode_cursor()
+    :returns: (team_id, player_id) tuple
+    :raises: ValueError if the cursor is malformed
+    '''
+    try:
+        key = base64.urlsafe_b64decode(cursor.encode('ascii'))
+        team_id, player_id = key.decode('ascii').split(':')
+        return (int(team_id), int(player_id))
+    except (binascii.Error, UnicodeError, ValueError):
+        raise ValueError('Invalid catalog cursor.')
+
+
+def catalog_page(session, cursor=None, limit=CATALOG_PAGE_SIZE):
+    '''
+    Fetch one keyset-paginated page of the catalog.
+    Pages are cut by rows, so a team whose players span a page boundary
+    shows up at the end of one page and again at the start of the next,
+    each time with its share of the players.
+
+    @param session: the DB session to run the query with
+    @param cursor: the cursor returned with the previous page, or None
+        to start from the beginning
+    @param limit: the maximum number of rows in the page
+    :returns: the catalog dict for the page, with a next_cursor key
+        that is None on the last page
+    :raises: ValueError if the cursor is malformed
+    '''
+    statement = catalog_select()
+    if cursor:
+        team_id, player_id = decode_cursor(cursor)
+        statement = statement.where(or_(
+            team_table.c.id > team_id,
+            and_(team_table.c.id == team_id,
+                 func.coalesce(player_table.c.id, 0) > player_id)
+        ))
+    rows = session.execute(statement.limit(limit)).fetchall()
+
+    page = build_catalog(rows)
+    page['next_cursor'] = None
+    if len(rows) == limit:
+        page['next_cursor'] = encode_cursor(rows[-1][0], rows[-1][3])
+
+    return page
+
+
+def parse_fields(fields, allowed=PLAYER_FIELDS):
+    '''
+    Parse a sparse fieldset, e.g. 'name,jersey_number'.
+
+    @param fields: the comma-separated field names, or None for all
+    @param allowed: the field names that may be picked
+    :returns: tuple of field names, or None for all
+    :raises: ValueError if a field is unknown
+    '''
+    if fields is None:
+        return None
+    names = tuple(name.strip() for name in fields.split(',') if name.strip())
+    unknown = [name for name in names if name not in allowed]
+    if unknown or not names:
+        raise ValueError('fields must be a comma-separated list of: '
+                         '{}.'.format(', '.join(allowed)))
+    return names
+
+
+def select_fields(data, fields):
+    '''
+    Trim a serialized object down to a sparse fieldset.
+
+    @param data: the serialized object, e.g. Player.serialize
+    @param fields: the field names to keep, or None to keep them all
+    :returns: the trimmed dict
+    '''
+    if fields is None:
+        return data
+    return dict((name, data[name]) for name in fields)
+
+
+def roster_page(session, team_id, after_id=0, limit=ROSTER_PAGE_SIZE,
+                fields=None):
+    '''
+    Fetch one keyset-paginated page of a team's players, by player id.
+
+    @param session: the DB session to run the query with
+    @param team_id: the id of the team
+    @param after_id: the id of the last player of the previous page, or 0
+        to start from the beginning
+    @param limit: the maximum number of players in the page
+    @param fields: the player fields to return, or None for all of them
+    :returns: dict with the players of the page and the next_after_id to
+        pass for the next page, None on the last page
+    '''
+    players = [PlayerRecord(*row) for row in session.execute(
+        select(PLAYER_COLUMNS).where(and_(
+            player_table.c.team_id == team_id,
+            player_table.c.id > after_id
+        )).order_by(
+            asc(player_table.c.id)
+        ).limit(limit))]
+
+    return {
+        'players': [select_fields(p.serialize, fields) for p in players],
+        'next_after_id': players[-1].id if len(players) == limit else None
+    }
+
+
+def get_catalog_version(session):
+    '''
+    Read the current catalog version.
+    The version row is created on first use.
+
+    @param session: the DB session to run the query with
+    :returns: (version, updated_at) tuple
+    '''
+    row = session.query(
+        CatalogVersion.version, CatalogVersion.updated_at
+    ).filter_by(id=1).one_or_none()
+    if row is None:
+        try:
+            session.add(CatalogVersion(
+                id=1, version=1, updated_at=datetime.utcnow()))
+            session.commit()
+        except IntegrityError:
+            # somebody else got there first, use theirs
+            session.rollback()
+        return get_catalog_version(session)
+
+    return (row[0], row[1])
+
+
+def bump_catalog_version(session):
+    '''
+    Increment the catalog version.
+    Must be called by every write path, in the same transaction as the
+    write itself, so the new version is visible exactly when the data is.
+
+    @param session: the DB session holding the write
+    '''
+    updated = session.query(CatalogVersion).filter_by(id=1).update({
+        CatalogVersion.version: CatalogVersion.version + 1,
+        CatalogVersion.updated_at: datetime.utcnow()
+    }, synchronize_session=False)
+    if not updated:
+        session.add(CatalogVersion(
+            id=1, version=1, updated_at=datetime.utcnow()))
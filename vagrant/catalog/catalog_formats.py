@@ -0,0 +1,197 @@
+'''
+Catalog formats.
+
+Flat and binary representations of the catalog, for bulk consumers that
+would rather not parse the nested JSON document of catalog.py:
+
+* msgpack: MessagePack, a stream of one map per team, the team's
+  serialize dict with the serialize dicts of its players under
+  'players'; read it with msgpack.Unpacker. Needs the msgpack package.
+* ndjson: one JSON object per line and player, the player's serialize
+  dict with the team's under 'team'.
+* csv: a header row, then one row per player: the serialize fields of
+  the player, then the name and nickname of the team.
+
+Each is written as the rows are read from the DB, one batch at a time.
+Teams without players only show up in msgpack, the flat formats having
+one entry per player.
+'''
+from collections import OrderedDict
+from sqlalchemy import asc, select
+from records import TeamRecord, PlayerRecord, TEAM_COLUMNS, PLAYER_COLUMNS
+from records import team_table, player_table
+from catalog import CATALOG_BATCH_SIZE
+import csv
+import io
+import json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+# format name: media type, the preferred one first
+FORMATS = OrderedDict([
+    ('json', 'application/json'),
+    ('msgpack', 'application/x-msgpack'),
+    ('ndjson', 'application/x-ndjson'),
+    ('csv', 'text/csv')
+])
+# the CSV columns, after the player fields
+CSV_TEAM_COLUMNS = ('team_name', 'team_nickname')
+# spreadsheets run cells starting with these as formulas
+_CSV_FORMULA_PREFIXES = ('=', '+', '-', '@')
+
+
+def negotiate_format(format_arg, accept_mimetypes):
+    '''
+    Pick the catalog format of a request: the format= argument if there
+    is one, else the best match of the Accept header, else JSON.
+
+    @param format_arg: the value of the format= argument, or None
+    @param accept_mimetypes: the parsed Accept header of the request
+    :returns: the format name, a key of FORMATS
+    :raises: ValueError if the format is unknown, or not available
+    '''
+    if format_arg is None:
+        mimetype = accept_mimetypes.best_match(
+            [m for f, m in FORMATS.items() if _available(f)],
+            FORMATS['json'])
+        return next(f for f, m in FORMATS.items() if m == mimetype)
+    if format_arg not in FORMATS:
+        raise ValueError('format must be one of {}.'.format(
+            ', '.join(FORMATS)))
+    if not _available(format_arg):
+        raise ValueError('format {} is not available.'.format(format_arg))
+    return format_arg
+
+
+def _available(name):
+    return name != 'msgpack' or msgpack is not None
+
+
+def catalog_records(session):
+    '''
+    Read the entire catalog as (team, player) record pairs, by team id,
+    then player id, fetching the rows as they are consumed. Teams without
+    players come with None for the player.
+
+    @param session: the DB session to run the select with
+    :returns: generator of (TeamRecord, PlayerRecord or None) tuples
+    '''
+    width = len(TEAM_COLUMNS)
+    result = session.execute(select(TEAM_COLUMNS + PLAYER_COLUMNS)
+                             .select_from(team_table.outerjoin(
+                                 player_table,
+                                 player_table.c.team_id == team_table.c.id))
+                             .order_by(asc(team_table.c.id),
+                                       asc(player_table.c.id))
+                             .execution_options(stream_results=True))
+    team = None
+    for row in result:
+        if team is None or team.id != row[0]:
+            team = TeamRecord(*row[:width])
+        player = PlayerRecord(*row[width:]) \
+            if row[width] is not None else None
+        yield (team, player)
+
+
+def stream_ndjson(records, batch_size=CATALOG_BATCH_SIZE):
+    '''
+    Serialize catalog records into NDJSON text chunks.
+
+    @param records: iterable of pairs as returned by catalog_records()
+    @param batch_size: number of players serialized per yielded chunk
+    :returns: generator of text chunks
+    '''
+    lines = []
+    for team, player in records:
+        if player is None:
+            continue
+        entry = player.serialize
+        entry['team'] = team.serialize
+        lines.append(json.dumps(entry, sort_keys=True))
+        if len(lines) == batch_size:
+            lines.append('')
+            yield '\n'.join(lines)
+            lines = []
+    if lines:
+        lines.append('')
+        yield '\n'.join(lines)
+
+
+def _csv_cell(value):
+    '''
+    Utility method: keep spreadsheets from running a text cell as a
+    formula, by quoting it the way they do.
+    '''
+    if isinstance(value, str) and value.startswith(_CSV_FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+
+def stream_csv(records, batch_size=CATALOG_BATCH_SIZE):
+    '''
+    Serialize catalog records into CSV text chunks, header row first.
+
+    @param records: iterable of pairs as returned by catalog_records()
+    @param batch_size: number of players serialized per yielded chunk
+    :returns: generator of text chunks
+    '''
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(PlayerRecord._fields + CSV_TEAM_COLUMNS)
+    count = 0
+    for team, player in records:
+        if player is None:
+            continue
+        serialized = player.serialize
+        writer.writerow([_csv_cell(serialized[field])
+                         for field in PlayerRecord._fields] +
+                        [_csv_cell(team.name), _csv_cell(team.nickname)])
+        count += 1
+        if count % batch_size == 0:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue()
+
+
+def stream_msgpack(records, batch_size=CATALOG_BATCH_SIZE):
+    '''
+    Serialize catalog records into MessagePack chunks, one map per team.
+    A team is packed once all of its players are read, so one team at
+    most is held in memory besides the current chunk.
+
+    @param records: iterable of pairs as returned by catalog_records()
+    @param batch_size: number of players serialized per yielded chunk
+    :returns: generator of byte chunks
+    '''
+    packer = msgpack.Packer(use_bin_type=True)
+    chunk = []
+    entry = None
+    count = 0
+    for team, player in records:
+        if entry is None or entry['id'] != team.id:
+            if entry is not None:
+                chunk.append(packer.pack(entry))
+            entry = team.serialize
+            entry['players'] = []
+        if player is not None:
+            entry['players'].append(player.serialize)
+            count += 1
+            if count % batch_size == 0 and chunk:
+                yield b''.join(chunk)
+                chunk = []
+    if entry is not None:
+        chunk.append(packer.pack(entry))
+    yield b''.join(chunk)
+
+
+# format name: function writing it, see FORMATS
+WRITERS = {
+    'msgpack': stream_msgpack,
+    'ndjson': stream_ndjson,
+    'csv': stream_csv
+}
@@ -0,0 +1,265 @@
+'''
+Player change log.
+
+Every write path appends one entry per player it creates, updates or
+deletes, in the same transaction as the write, see record_changes().
+Entries get increasing sequence numbers, so sync clients can ask for the
+changes since the last one they saw, see read_changes(), rather than
+download the whole catalog again. Updates and creates carry the player
+as the change left it; deletes are tombstones, which only name the
+player and its team.
+
+Clients that pass a client id have the sequence number they are at
+recorded, see acknowledge(). The entries every such client is past are
+compacted away, see compact(); clients not seen for
+CHANGE_CLIENT_TTL_DAYS stop holding compaction back. A client asking for
+changes since a compacted sequence number must download the catalog
+again.
+'''
+from collections import namedtuple
+from datetime import datetime, timedelta
+from sqlalchemy import asc, func, literal, select
+from db_setup import PlayerChange, ChangeCursor, ChangeFloor, Player
+import config
+import re
+
+
+# page size bounds for the change feed
+CHANGES_PAGE_SIZE = 100
+CHANGES_MAX_PAGE_SIZE = 1000
+
+CHANGE_OPS = ('create', 'update', 'delete')
+# the ids sync clients may go by
+CLIENT_ID = re.compile(r'^[A-Za-z0-9._-]{1,64}$')
+
+change_table = PlayerChange.__table__
+CHANGE_COLUMNS = [
+    change_table.c.seq,
+    change_table.c.op,
+    change_table.c.player_id,
+    change_table.c.team_id,
+    change_table.c.name,
+    change_table.c.jersey_number,
+    change_table.c.position,
+    change_table.c.user_id,
+    change_table.c.changed_at
+]
+
+
+class ChangesCompacted(Exception):
+    '''
+    Raised when the changes asked for were compacted away.
+    '''
+
+    def __init__(self, floor):
+        super(ChangesCompacted, self).__init__(
+            'changes up to {} were compacted away'.format(floor))
+        self.floor = floor
+
+
+class ChangeRecord(namedtuple('ChangeRecord', [
+        'seq', 'op', 'player_id', 'team_id', 'name', 'jersey_number',
+        'position', 'user_id', 'changed_at'])):
+    '''
+    Immutable, detached copy of a PlayerChange row.
+    '''
+    __slots__ = ()
+
+    @property
+    def serialize(self):
+        """Return object data in easily serializeable format."""
+        return {
+            'seq': self.seq,
+            'op': self.op,
+            'player_id': self.player_id,
+            'team_id': self.team_id,
+            'changed_at': self.changed_at.isoformat(),
+            # the same fields as Player.serialize, none for a tombstone
+            'player': {
+                'id': self.player_id,
+                'name': self.name,
+                'jersey_number': self.jersey_number,
+                'position': self.position,
+                'team_id': self.team_id,
+                'user_id': self.user_id
+            } if self.op != 'delete' else None
+        }
+
+
+def record_changes(session, op, players):
+    '''
+    Append changes of one kind to the log.
+    Call it after bump_catalog_version(), in the same transaction: the
+    version row lock it takes orders the writers, so the changes are
+    committed in sequence number order and readers never skip one.
+
+    @param session: the DB session holding the write
+    @param op: one of CHANGE_OPS
+    @param players: list of dicts shaped like Player.serialize, as the
+        change left them; deletes need only id and team_id
+    '''
+    if not players:
+        return
+    changed_at = datetime.utcnow()
+    tombstone = op == 'delete'
+    session.execute(change_table.insert(), [{
+        'op': op,
+        'player_id': p['id'],
+        'team_id': p['team_id'],
+        'name': None if tombstone else p['name'],
+        'jersey_number': None if tombstone else p['jersey_number'],
+        'position': None if tombstone else p['position'],
+        'user_id': None if tombstone else p['user_id'],
+        'changed_at': changed_at
+    } for p in players])
+
+
+def record_change(session, op, player):
+    '''
+    Append the change of one player to the log, see record_changes().
+
+    @param session: the DB session holding the write
+    @param op: one of CHANGE_OPS
+    @param player: the Player, flushed so that it has its id
+    '''
+    record_changes(session, op, [player.serialize])
+
+
+def last_player_id(session):
+    '''
+    :returns: the highest player id, 0 if there are no players
+    '''
+    return session.query(func.max(Player.id)).scalar() or 0
+
+
+def record_inserted(session, after_id):
+    '''
+    Log the creation of every player with an id above after_id, e.g. the
+    players of a bulk insert, straight from the player table. Read
+    after_id with last_player_id() after bump_catalog_version(), whose
+    row lock keeps other writers from inserting players meanwhile.
+
+    @param session: the DB session holding the insert
+    @param after_id: the highest player id before the insert
+    '''
+    player = Player.__table__
+    session.execute(change_table.insert().from_select(
+        ['op', 'player_id', 'team_id', 'name', 'jersey_number', 'position',
+         'user_id', 'changed_at'],
+        select([
+            literal('create'), player.c.id, player.c.team_id,
+            player.c.name, player.c.jersey_number, player.c.position,
+            player.c.user_id, literal(datetime.utcnow())
+        ]).where(player.c.id > after_id).order_by(asc(player.c.id))))
+
+
+def created_players(session, players):
+    '''
+    Find the rows of players just inserted with a bulk insert, which
+    returns no ids, by their team and jersey number, which are unique.
+
+    @param session: the DB session holding the insert
+    @param players: list of the inserted dicts, with team_id and
+        jersey_number
+    :returns: dict of (team_id, jersey_number) to the player dict,
+        shaped like Player.serialize
+    '''
+    if not players:
+        return {}
+    keys = set((p['team_id'], p['jersey_number']) for p in players)
+    rows = session.query(
+        Player.id, Player.name, Player.jersey_number, Player.position,
+        Player.team_id, Player.user_id
+    ).filter(
+        Player.team_id.in_(set(team_id for team_id, _ in keys)),
+        Player.jersey_number.in_(set(number for _, number in keys))
+    )
+    return dict(((row.team_id, row.jersey_number), {
+        'id': row.id,
+        'name': row.name,
+        'jersey_number': row.jersey_number,
+        'position': row.position,
+        'team_id': row.team_id,
+        'user_id': row.user_id
+    }) for row in rows if (row.team_id, row.jersey_number) in keys)
+
+
+def compacted_seq(session):
+    '''
+    :returns: the last sequence number compacted away, 0 if none
+    '''
+    seq = session.query(ChangeFloor.seq).filter_by(id=1).scalar()
+    return seq or 0
+
+
+def latest_seq(session):
+    '''
+    :returns: the sequence number of the last change, 0 if none
+    '''
+    seq = session.query(func.max(PlayerChange.seq)).scalar()
+    return max(seq or 0, compacted_seq(session))
+
+
+def read_changes(session, since, limit=CHANGES_PAGE_SIZE):
+    '''
+    Read the changes following a sequence number, oldest first.
+
+    @param session: the DB session to run the select with
+    @param since: the sequence number of the last change already seen,
+        0 for the first one
+    @param limit: the maximum number of changes
+    :returns: list of ChangeRecord
+    :raises: ChangesCompacted if changes after since were compacted away
+    '''
+    floor = compacted_seq(session)
+    if since < floor:
+        raise ChangesCompacted(floor)
+    return [ChangeRecord(*row) for row in session.execute(
+        select(CHANGE_COLUMNS).where(
+            change_table.c.seq > since
+        ).order_by(
+            asc(change_table.c.seq)
+        ).limit(limit))]
+
+
+def acknowledge(session, client_id, seq):
+    '''
+    Record that a client has every change up to a sequence number.
+
+    @param session: the DB session to write with
+    @param client_id: the id the client goes by
+    @param seq: the sequence number
+    '''
+    cursor = session.query(ChangeCursor).get(client_id)
+    if cursor is None:
+        cursor = ChangeCursor(client_id=client_id)
+        session.add(cursor)
+    cursor.seq = seq
+    cursor.seen_at = datetime.utcnow()
+
+
+def compact(session, settings=config):
+    '''
+    Delete the changes every client is past, and forget the clients not
+    seen for CHANGE_CLIENT_TTL_DAYS. With no clients, nothing is deleted.
+
+    @param session: the DB session to write with
+    @param settings: object holding the settings, see config.py
+    :returns: the number of changes deleted
+    '''
+    stale = datetime.utcnow() - timedelta(
+        days=settings.CHANGE_CLIENT_TTL_DAYS)
+    session.query(ChangeCursor).filter(
+        ChangeCursor.seen_at < stale).delete(synchronize_session=False)
+    low = session.query(func.min(ChangeCursor.seq)).scalar()
+    if low is None or low <= compacted_seq(session):
+        return 0
+
+    deleted = session.execute(change_table.delete().where(
+        change_table.c.seq <= low)).rowcount
+    floor = session.query(ChangeFloor).get(1)
+    if floor is None:
+        session.add(ChangeFloor(id=1, seq=low))
+    else:
+        floor.seq = low
+    return deleted
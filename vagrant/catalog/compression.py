@@ -0,0 +1,157 @@
+'''
+Response compression.
+
+Compresses the text responses of the app, JSON, HTML and the like, with
+brotli or gzip, whichever the client accepts, brotli first. Brotli needs
+the brotli package, and is left out without it. Responses smaller than
+COMPRESS_MIN_SIZE are sent as they are, since the framing would eat the
+savings. Streamed responses are compressed chunk by chunk as they are
+sent, so they still never sit in memory whole.
+
+A compressed response is a different representation from the plain one,
+so its strong ETag gets the encoding appended, e.g. catalog-v7-gzip;
+use etag_variants() to match If-None-Match against it.
+'''
+from flask import request
+import config
+import metrics
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# media types worth compressing
+COMPRESSIBLE_TYPES = frozenset([
+    'text/html',
+    'text/css',
+    'text/plain',
+    'text/csv',
+    'application/json',
+    'application/javascript',
+    'application/x-ndjson',
+    'application/x-msgpack'
+])
+
+
+def encodings():
+    '''
+    :returns: the encodings this process can produce, best first
+    '''
+    return ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+def etag_variants(etag):
+    '''
+    List the ETags a representation may have been sent with: the plain
+    one, and one per encoding.
+
+    @param etag: the ETag of the plain representation
+    :returns: list of ETags
+    '''
+    return [etag] + ['{}-{}'.format(etag, e) for e in encodings()]
+
+
+class Compressor(object):
+    '''
+    Incremental compressor for one encoding.
+    '''
+
+    def __init__(self, encoding, level):
+        '''
+        @param encoding: 'br' or 'gzip'
+        @param level: brotli quality (0-11), or gzip level (1-9)
+        '''
+        self.encoding = encoding
+        if encoding == 'br':
+            self._brotli = brotli.Compressor(quality=level)
+        else:
+            # wbits 16 + MAX_WBITS writes the gzip header and trailer
+            self._zlib = zlib.compressobj(
+                level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        if self.encoding == 'br':
+            return self._brotli.process(data)
+        return self._zlib.compress(data)
+
+    def finish(self):
+        if self.encoding == 'br':
+            return self._brotli.finish()
+        return self._zlib.flush()
+
+
+def _compress_stream(chunks, compressor):
+    '''
+    Utility method: compress the chunks of a streamed response. The
+    compressor holds output back until it has enough to work with, so
+    only non-empty chunks are passed on.
+    '''
+    try:
+        for chunk in chunks:
+            if not isinstance(chunk, bytes):
+                chunk = chunk.encode('utf-8')
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.finish()
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+def _negotiate():
+    for encoding in encodings():
+        if request.accept_encodings[encoding]:
+            return encoding
+    return None
+
+
+def init_app(app, settings=config):
+    '''
+    Compress the responses of the app.
+
+    @param app: the Flask app
+    @param settings: object holding the settings, see config.py
+    '''
+    @app.after_request
+    def compress_response(response):
+        if response.mimetype not in COMPRESSIBLE_TYPES or \
+                'Content-Encoding' in response.headers or \
+                response.direct_passthrough:
+            return response
+        response.vary.add('Accept-Encoding')
+
+        etag, weak = response.get_etag()
+        encoding = _negotiate()
+        if response.status_code == 304:
+            # name the representation the client has, see etag_variants()
+            if etag and not weak and encoding is not None and \
+                    request.if_none_match.contains(
+                        '{}-{}'.format(etag, encoding)):
+                response.set_etag('{}-{}'.format(etag, encoding))
+            return response
+        if encoding is None or response.status_code < 200 or \
+                response.status_code in (204, 206):
+            return response
+
+        compressor = Compressor(encoding, settings.COMPRESS_BROTLI_QUALITY
+                                if encoding == 'br' else
+                                settings.COMPRESS_LEVEL)
+        if response.is_streamed:
+            response.response = _compress_stream(
+                response.response, compressor)
+            response.headers.pop('Content-Length', None)
+        else:
+            data = response.get_data()
+            if len(data) < settings.COMPRESS_MIN_SIZE:
+                return response
+            with metrics.timer('compress'):
+                response.set_data(
+                    compressor.compress(data) + compressor.finish())
+        response.headers['Content-Encoding'] = encoding
+        if etag and not weak:
+            response.set_etag('{}-{}'.format(etag, encoding))
+        return response
@@ -0,0 +1,71 @@
+'''
+Application settings.
+Every setting can be overridden with an environment variable of the same
+name, prefixed with CATALOG_, e.g. CATALOG_DATABASE_URL.
+'''
+import os
+
+
+def _env(name, default, cast=str):
+    value = os.environ.get('CATALOG_' + name)
+    return default if value is None else cast(value)
+
+
+# signs the session cookie; must be the same for every server process
+SECRET_KEY = _env('SECRET_KEY', None)
+# WSGI server, see gunicorn.conf.py: listen address, worker processes per
+# machine (default: 2 per CPU, plus one), and threads per worker, which
+# should not exceed DATABASE_POOL_SIZE + DATABASE_MAX_OVERFLOW
+WSGI_BIND = _env('WSGI_BIND', '0.0.0.0:8000')
+WSGI_WORKERS = _env('WSGI_WORKERS', 0, int)
+WSGI_THREADS = _env('WSGI_THREADS', 4, int)
+# DB connection
+DATABASE_URL = _env('DATABASE_URL', 'sqlite:///roster.db')
+# read replicas, comma-separated URLs; GET requests read from them, see
+# database.py. A replica that fails is left alone for a while, and a user
+# who just wrote keeps reading from the primary until replicas catch up.
+DATABASE_REPLICA_URLS = _env(
+    'DATABASE_REPLICA_URLS', [],
+    lambda value: [url.strip() for url in value.split(',') if url.strip()])
+REPLICA_RETRY_SECONDS = _env('REPLICA_RETRY_SECONDS', 30, int)
+READ_YOUR_WRITES_SECONDS = _env('READ_YOUR_WRITES_SECONDS', 10, int)
+# connection pool, see sqlalchemy.create_engine()
+DATABASE_POOL_SIZE = _env('DATABASE_POOL_SIZE', 5, int)
+DATABASE_MAX_OVERFLOW = _env('DATABASE_MAX_OVERFLOW', 10, int)
+DATABASE_POOL_TIMEOUT = _env('DATABASE_POOL_TIMEOUT', 30, int)
+DATABASE_POOL_RECYCLE = _env('DATABASE_POOL_RECYCLE', 1800, int)
+# SQLite only: how long a writer waits on a locked DB, and page cache size
+SQLITE_BUSY_TIMEOUT_MS = _env('SQLITE_BUSY_TIMEOUT_MS', 5000, int)
+SQLITE_CACHE_SIZE_KB = _env('SQLITE_CACHE_SIZE_KB', 20000, int)
+# rendered page cache for anonymous visitors: size cap, and how long an
+# entry may live
+PAGE_CACHE_MAX_ENTRIES = _env('PAGE_CACHE_MAX_ENTRIES', 256, int)
+PAGE_CACHE_TTL = _env('PAGE_CACHE_TTL', 60, int)
+# how long clients may cache the fingerprinted static files, see assets.py
+ASSET_MAX_AGE = _env('ASSET_MAX_AGE', 365 * 24 * 3600, int)
+# response compression, see compression.py: smallest response worth it in
+# bytes, gzip level (1-9) and brotli quality (0-11)
+COMPRESS_MIN_SIZE = _env('COMPRESS_MIN_SIZE', 500, int)
+COMPRESS_LEVEL = _env('COMPRESS_LEVEL', 6, int)
+COMPRESS_BROTLI_QUALITY = _env('COMPRESS_BROTLI_QUALITY', 4, int)
+# change feed sync clients not seen for this long stop holding back the
+# compaction of the change log, see changes.py
+CHANGE_CLIENT_TTL_DAYS = _env('CHANGE_CLIENT_TTL_DAYS', 30, int)
+# log requests slower than this, with their SQL; 0 turns the log off
+SLOW_REQUEST_MS = _env('SLOW_REQUEST_MS', 0, int)
+# Google OAuth endpoints; point them at a local stub for tests/benchmarks
+GOOGLE_TOKENINFO_URL = _env(
+    'GOOGLE_TOKENINFO_URL', 'https://www.googleapis.com/oauth2/v1/tokeninfo')
+GOOGLE_USERINFO_URL = _env(
+    'GOOGLE_USERINFO_URL', 'https://www.googleapis.com/oauth2/v1/userinfo')
+GOOGLE_REVOKE_URL = _env(
+    'GOOGLE_REVOKE_URL', 'https://accounts.google.com/o/oauth2/revoke')
+# overrides the token_uri of client_secrets.json when set
+GOOGLE_TOKEN_URI = _env('GOOGLE_TOKEN_URI', None)
+# outgoing HTTP calls: timeouts in seconds, retries, keep-alive pool size
+HTTP_CONNECT_TIMEOUT = _env('HTTP_CONNECT_TIMEOUT', 3.05, float)
+HTTP_READ_TIMEOUT = _env('HTTP_READ_TIMEOUT', 10.0, float)
+HTTP_RETRIES = _env('HTTP_RETRIES', 2, int)
+HTTP_POOL_SIZE = _env('HTTP_POOL_SIZE', 10, int)
+# Google OAuth client configuration, reloaded when the file changes
+CLIENT_SECRETS_PATH = _env('CLIENT_SECRETS_PATH', 'client_secrets.json')
@@ -0,0 +1,227 @@
+from flask import _app_ctx_stack, request, session as login_session
+from sqlalchemy import event
+from sqlalchemy.orm import scoped_session, sessionmaker, Session
+from db_setup import Base, make_engine
+import db_setup
+from replicas import ReplicaSet
+import config
+import os
+import threading
+import time
+
+
+# HTTP methods whose requests may read from a replica
+READ_ONLY_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS'])
+# login session key: until when the user reads from the primary
+_PRIMARY_UNTIL = 'db_primary_until'
+
+
+class RoutingSession(Session):
+    '''
+    Session sending its statements to the primary, or to a replica when
+    it is marked read-only, see init_app(). Flushes always go to the
+    primary. The replica connection is opened on the first statement and
+    closed with the session; when no replica is up, the primary is used.
+    '''
+
+    def get_bind(self, mapper=None, clause=None):
+        if self._flushing or not self.info.get('read_only'):
+            return get_engine()
+        connection = self.info.get('replica_connection')
+        if connection is None:
+            connection = get_replicas().connect()
+            if connection is None:
+                self.info['read_only'] = False
+                return get_engine()
+            self.info['replica_connection'] = connection
+        return connection
+
+    def close(self):
+        super(RoutingSession, self).close()
+        connection = self.info.pop('replica_connection', None)
+        if connection is not None:
+            connection.close()
+
+
+# one session per app context, i.e. per request; see init_app().
+# It is bound to the engine of the process by get_engine().
+db_session = scoped_session(
+    sessionmaker(class_=RoutingSession),
+    scopefunc=_app_ctx_stack.__ident_func__
+)
+
+# the engines of this process, built on first use; see get_engine()
+_engine_state = {
+    'engine': None,
+    'replicas': None,
+    'pid': None,
+    'settings': config
+}
+_engine_lock = threading.Lock()
+_engine_callbacks = []
+
+# pool statistics, for measuring connection usage per request
+_pool_stats = {'checkouts': 0}
+_pool_stats_lock = threading.Lock()
+
+
+def _count_checkout(dbapi_connection, connection_record, connection_proxy):
+    with _pool_stats_lock:
+        _pool_stats['checkouts'] += 1
+
+
+def pool_checkouts():
+    '''
+    Count the connections checked out of the pool so far.
+    Diff two readings to get the checkouts in between.
+
+    :returns: the number of checkouts since the process started
+    '''
+    return _pool_stats['checkouts']
+
+
+def configure(settings):
+    '''
+    Set the settings the engine is built from. Takes effect the next time
+    the engine is built, see get_engine() and dispose_engine().
+
+    @param settings: object holding the settings, see config.py
+    '''
+    _engine_state['settings'] = settings
+
+
+def on_engine(callback):
+    '''
+    Have a function called with every engine built, e.g. to listen to its
+    events. Called right away if the engine is already built.
+
+    @param callback: function taking the engine
+    '''
+    _engine_callbacks.append(callback)
+    engine = _engine_state['engine']
+    if engine is not None and _engine_state['pid'] == os.getpid():
+        callback(engine)
+
+
+def get_engine():
+    '''
+    Get the engine of this process, building it, and the replica engines,
+    on first use. Connections must not be shared across a fork, so a
+    process forked after the engine was built, e.g. a WSGI server worker,
+    gets its own. The schema is left as it is, see create_schema().
+
+    :returns: the engine of the primary DB
+    '''
+    if _engine_state['pid'] != os.getpid():
+        with _engine_lock:
+            if _engine_state['pid'] != os.getpid():
+                settings = _engine_state['settings']
+                engine = make_engine(settings)
+                replicas = ReplicaSet(
+                    settings.DATABASE_REPLICA_URLS, settings)
+                for e in [engine] + replicas.engines:
+                    event.listen(e, 'checkout', _count_checkout)
+                    for callback in _engine_callbacks:
+                        callback(e)
+                Base.metadata.bind = engine
+                db_session.configure(bind=engine)
+                _engine_state['engine'] = engine
+                _engine_state['replicas'] = replicas
+                _engine_state['pid'] = os.getpid()
+    return _engine_state['engine']
+
+
+def create_schema():
+    '''
+    Bring the DB schema up to date, see db_setup.create_schema(). Call
+    once before serving, in the process that starts the workers, e.g.
+    from a gunicorn on_starting hook, then dispose_engine().
+
+    :returns: the schema version
+    '''
+    return db_setup.create_schema(get_engine())
+
+
+def get_replicas():
+    '''
+    Get the replica engines of this process, see get_engine().
+
+    :returns: the ReplicaSet, empty when there are no replicas
+    '''
+    get_engine()
+    return _engine_state['replicas']
+
+
+def dispose_engine():
+    '''
+    Close the pooled connections of the engine and forget it; the next
+    get_engine() builds a new one. Call right after forking a process
+    whose parent used the DB, e.g. from a gunicorn post_fork hook.
+    '''
+    with _engine_lock:
+        engine = _engine_state['engine']
+        replicas = _engine_state['replicas']
+        _engine_state['engine'] = None
+        _engine_state['replicas'] = None
+        _engine_state['pid'] = None
+    if engine is not None:
+        engine.dispose()
+    if replicas is not None:
+        replicas.dispose()
+
+
+def use_primary():
+    '''
+    Send the rest of the request's statements to the primary, e.g. for a
+    GET that writes, or that must not lag behind the writes.
+    '''
+    db_session.info['read_only'] = False
+
+
+def _reads_from_replica():
+    '''
+    Utility method: tell if the current request may read from a replica.
+    Writes go to the primary, and so do the reads of the user for
+    READ_YOUR_WRITES_SECONDS after, so they see their changes before the
+    replicas do.
+    '''
+    if not get_replicas():
+        return False
+    if request.method not in READ_ONLY_METHODS:
+        login_session[_PRIMARY_UNTIL] = time.time() + \
+            _engine_state['settings'].READ_YOUR_WRITES_SECONDS
+        return False
+    primary_until = login_session.get(_PRIMARY_UNTIL)
+    if primary_until is None:
+        return True
+    if primary_until > time.time():
+        return False
+    del login_session[_PRIMARY_UNTIL]
+    return True
+
+
+def init_app(app):
+    '''
+    Hook the request-scoped session into the app's lifecycle.
+    The engine is built by the first request, not when the app is, so an
+    app created before the WSGI server forks its workers is safe to use.
+    Requests that only read use a replica, if there are any, see
+    RoutingSession.
+    When the request ends the session is committed, or rolled back if
+    the request failed, and then discarded.
+
+    @param app: the Flask app
+    '''
+    @app.before_request
+    def bind_session():
+        db_session.info['read_only'] = _reads_from_replica()
+
+    @app.teardown_appcontext
+    def end_session(exception=None):
+        try:
+            if exception is None:
+                db_session.commit()
+            else:
+                db_session.rollback()
+        finally:
+            db_session.remove()
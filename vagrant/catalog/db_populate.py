@@ -1,8 +1,8 @@
-from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
-from db_setup import Base, User, Team, Player
+from db_setup import Base, User, Team, Player, setup_engine
+from catalog import bump_catalog_version
 
-engine = create_engine('sqlite:///roster.db')
+engine = setup_engine()
 Base.metadata.bind = engine
 DBSession = sessionmaker(bind=engine)
 session = DBSession()
@@ -243,4 +243,7 @@ greiss = Player(
 session.add(greiss)
 session.commit()
 
+bump_catalog_version(session)
+session.commit()
+
 print('Done populating DB.')
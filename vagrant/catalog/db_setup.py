@@ -1,17 +1,48 @@
-from sqlalchemy import Column, ForeignKey, Integer, String
+from sqlalchemy import Column, ForeignKey, Integer, String, DateTime
+from sqlalchemy import SmallInteger, Index, CheckConstraint
+from sqlalchemy.types import TypeDecorator
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+from migrations import upgrade
+import config
 
 Base = declarative_base()
 
+# the positions a player can play, in roster display order
+POSITIONS = ('Goaltender', 'Defenceman', 'Offenceman')
+
+
+class Position(TypeDecorator):
+    '''
+    A player position, stored as its index in POSITIONS.
+    Python code only ever sees the position names; sorting on the column
+    sorts positions in roster display order.
+    '''
+    impl = SmallInteger
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        try:
+            return POSITIONS.index(value)
+        except ValueError:
+            raise ValueError('Unknown position: {!r}'.format(value))
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return POSITIONS[value]
+
 
 class User(Base):
     __tablename__ = 'user'
 
     id = Column(Integer, primary_key=True)
     name = Column(String(250), nullable=False)
-    email = Column(String(250), nullable=False)
+    email = Column(String(250), nullable=False, index=True)
 
 
 class Team(Base):
@@ -33,14 +64,24 @@ class Team(Base):
 
 class Player(Base):
     __tablename__ = 'player'
+    __table_args__ = (
+        # jersey numbers are unique per team; also serves team_id lookups
+        Index('ix_player_team_jersey', 'team_id', 'jersey_number',
+              unique=True),
+        # rosters are listed by position, then jersey number
+        Index('ix_player_team_position_jersey', 'team_id', 'position',
+              'jersey_number'),
+        CheckConstraint('position >= 0 AND position < {}'.format(
+            len(POSITIONS)), name='ck_player_position'),
+    )
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     name = Column(String(50), nullable=False)
     jersey_number = Column(Integer, nullable=False)
-    position = Column(String(15), nullable=False)
+    position = Column(Position, nullable=False)
     team_id = Column(Integer, ForeignKey('team.id'))
     team = relationship(Team)
-    user_id = Column(Integer, ForeignKey('user.id'))
+    user_id = Column(Integer, ForeignKey('user.id'), index=True)
     user = relationship(User)
 
     @property
@@ -56,7 +97,131 @@ class Player(Base):
         }
 
 
-engine = create_engine('sqlite:///roster.db')
+class CatalogVersion(Base):
+    __tablename__ = 'catalog_version'
 
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False)
+    updated_at = Column(DateTime, nullable=False)
+
+
+def make_engine(settings=config, url=None):
+    '''
+    Build the DB engine from the settings.
+    File-backed SQLite DBs get a real connection pool, and every new
+    connection is switched to WAL journaling so readers no longer block
+    behind writers. Server DBs get a pool sized from the settings.
+
+    @param settings: object holding the settings, see config.py
+    @param url: the DB URL, if not settings.DATABASE_URL, e.g. a replica
+    :returns: the engine
+    '''
+    url = make_url(url or settings.DATABASE_URL)
+    pool_args = {
+        'pool_size': settings.DATABASE_POOL_SIZE,
+        'max_overflow': settings.DATABASE_MAX_OVERFLOW,
+        'pool_timeout': settings.DATABASE_POOL_TIMEOUT,
+        'pool_recycle': settings.DATABASE_POOL_RECYCLE
+    }
+    if url.get_backend_name() != 'sqlite':
+        return create_engine(url, pool_pre_ping=True, **pool_args)
+
+    if url.database in (None, '', ':memory:'):
+        # in-memory DBs live and die with their one connection
+        return create_engine(url)
+
+    engine = create_engine(
+        url,
+        poolclass=QueuePool,
+        connect_args={
+            'timeout': settings.SQLITE_BUSY_TIMEOUT_MS / 1000.0,
+            'check_same_thread': False
+        },
+        **pool_args
+    )
+
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute('PRAGMA busy_timeout={:d}'.format(
+            settings.SQLITE_BUSY_TIMEOUT_MS))
+        cursor.execute('PRAGMA cache_size=-{:d}'.format(
+            settings.SQLITE_CACHE_SIZE_KB))
+        cursor.close()
+
+    return engine
+
+
+class ImportProgress(Base):
+    __tablename__ = 'import_progress'
+
+    source = Column(String(500), primary_key=True)
+    records = Column(Integer, nullable=False)
+    updated_at = Column(DateTime, nullable=False)
+
+
+class PlayerChange(Base):
+    __tablename__ = 'player_change'
+    # sequence numbers are never reused, even once compaction has emptied
+    # the table; see changes.py
+    __table_args__ = {'sqlite_autoincrement': True}
+
+    seq = Column(Integer, primary_key=True)
+    op = Column(String(6), nullable=False)
+    player_id = Column(Integer, nullable=False)
+    # the player as the change left it; only team_id is kept for deletes
+    team_id = Column(Integer)
+    name = Column(String(50))
+    jersey_number = Column(Integer)
+    position = Column(Position)
+    user_id = Column(Integer)
+    changed_at = Column(DateTime, nullable=False)
+
+
+class ChangeCursor(Base):
+    __tablename__ = 'change_cursor'
+
+    client_id = Column(String(64), primary_key=True)
+    seq = Column(Integer, nullable=False)
+    seen_at = Column(DateTime, nullable=False)
+
+
+class ChangeFloor(Base):
+    __tablename__ = 'change_floor'
 
-Base.metadata.create_all(engine)
+    id = Column(Integer, primary_key=True)
+    # the last sequence number compacted out of the change log
+    seq = Column(Integer, nullable=False)
+
+
+def create_schema(engine):
+    '''
+    Bring the DB schema up to date, creating the tables and applying the
+    pending migrations.
+    Processes creating the same tables at once fail, so do this once,
+    before starting the processes that use the DB, e.g. the workers of a
+    WSGI server.
+
+    @param engine: the engine of the DB
+    :returns: the schema version
+    '''
+    Base.metadata.create_all(engine)
+    return upgrade(engine)
+
+
+def setup_engine(settings=config):
+    '''
+    Build the DB engine from the settings, and bring the DB schema up to
+    date, see create_schema(). For scripts running on their own; the app
+    only builds the engine, see database.get_engine().
+    Nothing connects to the DB before this is called, so call it after
+    forking, in the process that will use the engine.
+
+    @param settings: object holding the settings, see config.py
+    :returns: the engine
+    '''
+    engine = make_engine(settings)
+    create_schema(engine)
+    return engine
@@ -0,0 +1,223 @@
+'''
+Google OAuth client configuration and HTTP client.
+
+The client secrets file is parsed once and kept in memory until the file
+changes or forget_client_secrets() is called.
+
+Every call goes through one keep-alive session per process, with a
+bounded connection pool, strict timeouts and a few retries on connection
+errors and 5xx answers, so a slow Google can not pin a worker for long.
+'''
+from collections import namedtuple
+from oauth2client.client import OAuth2WebServerFlow
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import config
+import httplib2
+import json
+import os
+import requests
+import threading
+
+
+class GoogleAPIError(Exception):
+    '''
+    Google could not be reached, or answered with garbage.
+    '''
+    pass
+
+
+class ClientSecrets(namedtuple('ClientSecrets', [
+        'client_id', 'client_secret', 'auth_uri', 'token_uri', 'revoke_uri',
+        'mtime'])):
+    '''
+    Immutable, parsed copy of the client secrets file.
+    '''
+    __slots__ = ()
+
+    def flow(self, scope='', redirect_uri='postmessage'):
+        '''
+        Build an OAuth flow for this client.
+
+        @param scope: the requested scope
+        @param redirect_uri: the redirect URI of the flow
+        :returns: an OAuth2WebServerFlow
+        '''
+        return OAuth2WebServerFlow(
+            client_id=self.client_id,
+            client_secret=self.client_secret,
+            scope=scope,
+            redirect_uri=redirect_uri,
+            auth_uri=self.auth_uri,
+            token_uri=self.token_uri,
+            revoke_uri=self.revoke_uri
+        )
+
+
+# the settings the client is built from, see configure()
+_settings = config
+_secrets = None
+_secrets_lock = threading.Lock()
+_session = None
+_session_lock = threading.Lock()
+
+
+def configure(settings):
+    '''
+    Set the settings the client is built from. The client secrets and the
+    HTTP session are built again from them on next use.
+
+    @param settings: object holding the settings, see config.py
+    '''
+    global _settings, _secrets, _session
+    with _secrets_lock, _session_lock:
+        _settings = settings
+        _secrets = None
+        _session = None
+
+
+def _load_client_secrets(path):
+    mtime = os.stat(path).st_mtime
+    with open(path, 'r') as f:
+        web = json.load(f)['web']
+    return ClientSecrets(
+        client_id=web['client_id'],
+        client_secret=web['client_secret'],
+        auth_uri=web['auth_uri'],
+        token_uri=_settings.GOOGLE_TOKEN_URI or web['token_uri'],
+        revoke_uri=web.get('revoke_uri', _settings.GOOGLE_REVOKE_URL),
+        mtime=mtime
+    )
+
+
+def client_secrets():
+    '''
+    :returns: the ClientSecrets, re-read only if the file has changed
+        since it was last loaded
+    '''
+    global _secrets
+    secrets = _secrets
+    if secrets is None or \
+            os.stat(_settings.CLIENT_SECRETS_PATH).st_mtime != secrets.mtime:
+        with _secrets_lock:
+            secrets = _secrets = _load_client_secrets(
+                _settings.CLIENT_SECRETS_PATH)
+    return secrets
+
+
+def forget_client_secrets(*args):
+    '''
+    Drop the parsed client secrets, so the next client_secrets() re-reads
+    the file.
+    Takes and ignores any arguments, so it can be used as a signal handler.
+    It takes no lock: the handler runs on the main thread, which may be
+    holding _secrets_lock in client_secrets() when the signal arrives.
+    '''
+    global _secrets
+    _secrets = None
+
+
+def _retry():
+    retry_args = {
+        'total': _settings.HTTP_RETRIES,
+        'backoff_factor': 0.2,
+        'status_forcelist': (500, 502, 503, 504),
+        'raise_on_status': False
+    }
+    # urllib3 renamed method_whitelist to allowed_methods
+    methods = frozenset(['GET', 'POST'])
+    try:
+        return Retry(allowed_methods=methods, **retry_args)
+    except TypeError:
+        return Retry(method_whitelist=methods, **retry_args)
+
+
+def http_session():
+    '''
+    :returns: the process-wide requests session
+    '''
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(
+                    pool_connections=_settings.HTTP_POOL_SIZE,
+                    pool_maxsize=_settings.HTTP_POOL_SIZE,
+                    max_retries=_retry()
+                )
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _session = session
+    return _session
+
+
+def exchange_http():
+    '''
+    :returns: an httplib2 client with the read timeout, for the code
+        exchange done by oauth2client; httplib2 clients are not
+        thread-safe, so every exchange gets its own
+    '''
+    return httplib2.Http(timeout=_settings.HTTP_READ_TIMEOUT)
+
+
+def _call(method, url, **kwargs):
+    try:
+        response = http_session().request(
+            method, url,
+            timeout=(_settings.HTTP_CONNECT_TIMEOUT,
+                     _settings.HTTP_READ_TIMEOUT),
+            **kwargs
+        )
+        return response
+    except requests.RequestException as e:
+        raise GoogleAPIError('{} {} failed: {}'.format(method, url, e))
+
+
+def _json(response):
+    try:
+        return response.json()
+    except ValueError:
+        raise GoogleAPIError('{} answered {} with no JSON.'.format(
+            response.url, response.status_code))
+
+
+def get_token_info(access_token):
+    '''
+    Ask Google about an access token.
+
+    @param access_token: the access token
+    :returns: the token info dict; it has an 'error' key if the token
+        is not valid
+    :raises: GoogleAPIError if Google could not be reached
+    '''
+    return _json(_call('GET', _settings.GOOGLE_TOKENINFO_URL,
+                       params={'access_token': access_token}))
+
+
+def get_user_info(access_token):
+    '''
+    Fetch the profile of the user owning an access token.
+
+    @param access_token: the access token
+    :returns: the user info dict
+    :raises: GoogleAPIError if Google could not be reached
+    '''
+    return _json(_call('GET', _settings.GOOGLE_USERINFO_URL,
+                       params={'access_token': access_token, 'alt': 'json'}))
+
+
+def revoke_token(access_token):
+    '''
+    Invalidate an access token.
+
+    @param access_token: the access token
+    :returns: True if Google confirmed the revocation
+    :raises: GoogleAPIError if Google could not be reached
+    '''
+    response = _call(
+        'POST', _settings.GOOGLE_REVOKE_URL,
+        params={'token': access_token},
+        headers={'content-type': 'application/x-www-form-urlencoded'}
+    )
+    return response.status_code == 200
@@ -0,0 +1,38 @@
+'''
+gunicorn settings, see config.py for the environment variables.
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+Each worker is a process with its own DB connection pool, serving
+WSGI_THREADS requests at a time. SQLite allows a single writer at a time,
+whatever the number of workers; WAL mode lets readers carry on meanwhile.
+'''
+import multiprocessing
+# gunicorn has a "config" setting of its own, do not shadow it
+import config as catalog_config
+
+
+bind = catalog_config.WSGI_BIND
+workers = catalog_config.WSGI_WORKERS or \
+    multiprocessing.cpu_count() * 2 + 1
+threads = catalog_config.WSGI_THREADS
+worker_class = 'gthread' if threads > 1 else 'sync'
+# recycle idle keep-alive connections, and workers stuck on a request
+keepalive = 5
+timeout = 30
+graceful_timeout = 30
+
+
+def on_starting(server):
+    # bring the DB schema up to date once, before the workers start;
+    # workers creating the tables at once would fail
+    import database
+    database.create_schema()
+    database.dispose_engine()
+
+
+def post_fork(server, worker):
+    # the DB connections of the master process, if it made any, must not
+    # be used by the workers
+    import database
+    database.dispose_engine()
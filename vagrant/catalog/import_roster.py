@@ -0,0 +1,307 @@
+'''
+Bulk roster import.
+
+Streams teams and players from CSV, JSON or NDJSON files into the DB in
+batched transactions. Usage:
+
+    python3 import_roster.py --teams teams.csv --players players.ndjson
+
+Team records need name and nickname. Player records need name,
+jersey_number, position and team (the team nickname), and may carry a
+user_id; --user-id sets the owner of players that do not.
+
+Every batch is committed together with the number of source records
+consumed so far, so an import that fails half-way picks up after the
+last committed batch when re-run with --resume.
+'''
+from sqlalchemy.orm import sessionmaker
+from db_setup import User, Team, Player, ImportProgress, POSITIONS
+from db_setup import setup_engine
+from catalog import bump_catalog_version
+from changes import last_player_id, record_inserted
+from datetime import datetime
+import argparse
+import csv
+import itertools
+import json
+import os
+import sys
+import time
+
+
+DEFAULT_BATCH_SIZE = 5000
+
+
+class RejectedRecord(Exception):
+    pass
+
+
+class UnreadableRecord(object):
+    '''
+    Stands in for a record that could not be parsed, e.g. a malformed
+    NDJSON line, so that it is rejected like an invalid one.
+    '''
+
+    def __init__(self, text, reason):
+        '''
+        @param text: the unparsed text of the record
+        @param reason: why it could not be parsed
+        '''
+        self.text = text
+        self.reason = reason
+
+
+def read_records(path):
+    '''
+    Read records from a CSV, JSON or NDJSON file, by file extension.
+    CSV and NDJSON files are streamed; a JSON file holds one array of
+    records and is parsed as a whole, so prefer NDJSON for big imports.
+
+    @param path: the path of the file
+    :returns: generator of record dicts, or of whatever else the JSON
+        holds, and of an UnreadableRecord per malformed NDJSON line
+    '''
+    extension = os.path.splitext(path)[1].lower()
+    with open(path, newline='') as f:
+        if extension == '.csv':
+            for record in csv.DictReader(f):
+                yield record
+        elif extension in ('.ndjson', '.jsonl'):
+            for number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    yield json.loads(line)
+                except ValueError as e:
+                    # JSONDecodeError, whose position is within the line
+                    yield UnreadableRecord(
+                        line.rstrip('\n'),
+                        'line {} is not valid JSON: {}'.format(
+                            number, getattr(e, 'msg', e)))
+        elif extension == '.json':
+            for record in json.load(f):
+                yield record
+        else:
+            raise ValueError('Unknown file format: {}'.format(path))
+
+
+def _text(record, field):
+    '''
+    Utility method: the stripped text of a record field, '' if missing.
+
+    :raises: RejectedRecord if the field is not text
+    '''
+    value = record.get(field)
+    if value is None:
+        return ''
+    if not isinstance(value, str):
+        raise RejectedRecord('{} must be text'.format(field))
+    return value.strip()
+
+
+class RosterImporter(object):
+    '''
+    Validates records in memory and inserts them in batches.
+    '''
+
+    def __init__(self, session, batch_size=DEFAULT_BATCH_SIZE,
+                 rejects=None, user_id=None, out=sys.stdout):
+        '''
+        @param session: the DB session to import with
+        @param batch_size: number of records committed per transaction
+        @param rejects: file to write rejected records to, as NDJSON
+        @param user_id: owner of the players that name none
+        @param out: file to report progress to
+        '''
+        self.session = session
+        self.batch_size = batch_size
+        self.rejects = rejects
+        self.user_id = user_id
+        self.out = out
+
+    def import_teams(self, path, resume=False):
+        '''
+        Import the teams in a file.
+
+        @param path: the path of the file
+        @param resume: skip the records already imported by a failed run
+        :returns: (imported, rejected) tuple of counts
+        '''
+        names = set()
+        nicknames = set()
+        for name, nickname in self.session.query(Team.name, Team.nickname):
+            names.add(name)
+            nicknames.add(nickname)
+
+        def validate(record):
+            name = _text(record, 'name')
+            nickname = _text(record, 'nickname')
+            if not name or len(name) > 100:
+                raise RejectedRecord('team name must be 1-100 characters')
+            if not nickname or len(nickname) > 25:
+                raise RejectedRecord('nickname must be 1-25 characters')
+            if name in names or nickname in nicknames:
+                raise RejectedRecord('team already exists')
+            names.add(name)
+            nicknames.add(nickname)
+            return {'name': name, 'nickname': nickname}
+
+        return self._import('teams', path, Team.__table__, validate, resume)
+
+    def import_players(self, path, resume=False):
+        '''
+        Import the players in a file.
+
+        @param path: the path of the file
+        @param resume: skip the records already imported by a failed run
+        :returns: (imported, rejected) tuple of counts
+        '''
+        teams = dict(self.session.query(Team.nickname, Team.id))
+        users = set(user_id for (user_id,) in self.session.query(User.id))
+        taken = set(self.session.query(Player.team_id, Player.jersey_number))
+
+        def validate(record):
+            name = _text(record, 'name')
+            if not name or len(name) > 50:
+                raise RejectedRecord('player name must be 1-50 characters')
+            try:
+                jersey_number = int(record.get('jersey_number'))
+            except (TypeError, ValueError):
+                raise RejectedRecord('jersey number must be an integer')
+            if not (jersey_number > 0 and jersey_number < 100):
+                raise RejectedRecord('jersey number must be between 1 and 99')
+            position = record.get('position')
+            if position not in POSITIONS:
+                raise RejectedRecord('unknown position')
+            team_id = teams.get(_text(record, 'team'))
+            if team_id is None:
+                raise RejectedRecord('unknown team')
+            try:
+                user_id = int(record.get('user_id') or self.user_id)
+            except (TypeError, ValueError):
+                raise RejectedRecord('player has no owner')
+            if user_id not in users:
+                raise RejectedRecord('unknown user')
+            if (team_id, jersey_number) in taken:
+                raise RejectedRecord('jersey number already taken')
+            taken.add((team_id, jersey_number))
+            return {
+                'name': name,
+                'jersey_number': jersey_number,
+                'position': position,
+                'team_id': team_id,
+                'user_id': user_id
+            }
+
+        return self._import(
+            'players', path, Player.__table__, validate, resume)
+
+    def _import(self, kind, path, table, validate, resume):
+        source = '{}:{}'.format(kind, os.path.abspath(path))
+        progress = self.session.query(ImportProgress).get(source)
+        if progress is None:
+            progress = ImportProgress(
+                source=source, records=0, updated_at=datetime.utcnow())
+            self.session.add(progress)
+        skip = progress.records if resume else 0
+
+        records = enumerate(read_records(path), 1)
+        if skip:
+            records = itertools.islice(records, skip, None)
+            self._report(kind, 'resuming after record {}'.format(skip))
+
+        imported = 0
+        rejected = 0
+        batch = []
+        started = time.time()
+        position = skip
+        for position, record in records:
+            try:
+                if isinstance(record, UnreadableRecord):
+                    raise RejectedRecord(record.reason)
+                if not isinstance(record, dict):
+                    raise RejectedRecord('record must be an object')
+                batch.append(validate(record))
+            except RejectedRecord as e:
+                rejected += 1
+                self._reject(kind, position, record, str(e))
+            if len(batch) >= self.batch_size:
+                imported += self._commit(table, batch, progress, position)
+                batch = []
+                self._report(kind, self._rate(imported, rejected, started))
+        imported += self._commit(table, batch, progress, position)
+
+        self._report(kind, 'done, ' + self._rate(imported, rejected, started))
+        return (imported, rejected)
+
+    def _commit(self, table, batch, progress, position):
+        if batch:
+            bump_catalog_version(self.session)
+            if table is Player.__table__:
+                after_id = last_player_id(self.session)
+            self.session.execute(table.insert(), batch)
+            if table is Player.__table__:
+                # sync clients see imported players as created
+                record_inserted(self.session, after_id)
+        progress.records = position
+        progress.updated_at = datetime.utcnow()
+        self.session.commit()
+        return len(batch)
+
+    def _reject(self, kind, position, record, reason):
+        if isinstance(record, UnreadableRecord):
+            record = record.text
+        if self.rejects is not None:
+            self.rejects.write(json.dumps({
+                'kind': kind,
+                'record_number': position,
+                'reason': reason,
+                'record': record
+            }) + '\n')
+
+    def _rate(self, imported, rejected, started):
+        elapsed = max(time.time() - started, 1e-6)
+        return '{} rows imported ({:.0f} rows/s), {} rejected'.format(
+            imported, imported / elapsed, rejected)
+
+    def _report(self, kind, message):
+        self.out.write('{}: {}\n'.format(kind, message))
+        self.out.flush()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Bulk import teams and players.')
+    parser.add_argument('--teams', help='CSV/JSON/NDJSON file of teams')
+    parser.add_argument('--players', help='CSV/JSON/NDJSON file of players')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help='records per transaction (default: %(default)s)')
+    parser.add_argument('--user-id', type=int,
+                        help='owner of players that name no user_id')
+    parser.add_argument('--rejects', help='write rejected records here')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue a failed import of the same files')
+    args = parser.parse_args(argv)
+    if not (args.teams or args.players):
+        parser.error('nothing to import, pass --teams and/or --players')
+    if args.batch_size < 1:
+        parser.error('--batch-size must be positive')
+
+    rejects = open(args.rejects, 'w') if args.rejects else None
+    session = sessionmaker(bind=setup_engine())()
+    try:
+        importer = RosterImporter(
+            session, args.batch_size, rejects, args.user_id)
+        # teams first, players refer to them
+        if args.teams:
+            importer.import_teams(args.teams, args.resume)
+        if args.players:
+            importer.import_players(args.players, args.resume)
+    finally:
+        session.close()
+        if rejects is not None:
+            rejects.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+'''
+Synthetic league generator.
+
+Builds a league of configurable size into a scratch DB, for benchmarks.
+The same arguments always produce the same league. Usage:
+
+    python3 league_gen.py --database-url sqlite:///bench.db \
+        --teams 1000 --players-per-team 99 --users 500
+'''
+import argparse
+import os
+import random
+
+
+FIRST_NAMES = (
+    'Adam', 'Anders', 'Brad', 'Carter', 'Connor', 'Dan', 'Erik', 'Filip',
+    'Henrik', 'Jack', 'Juuse', 'Kyle', 'Leon', 'Mats', 'Mikko', 'Nathan',
+    'Nikita', 'Patrik', 'Pekka', 'Roman', 'Ryan', 'Sidney', 'Tuukka',
+    'Viktor', 'Yanni', 'Zach'
+)
+LAST_NAMES = (
+    'Arvidsson', 'Backstrom', 'Crosby', 'Draisaitl', 'Ellis', 'Forsberg',
+    'Gaudreau', 'Hamhuis', 'Josi', 'Kane', 'Laine', 'MacKinnon', 'Makar',
+    'Ovechkin', 'Pastrnak', 'Rask', 'Rinne', 'Saros', 'Stamkos', 'Tavares',
+    'Turris', 'Vasilevskiy', 'Watson', 'Zibanejad'
+)
+# roughly the make-up of a real roster
+POSITION_WEIGHTS = (
+    ('Goaltender', 1), ('Defenceman', 3), ('Offenceman', 5)
+)
+BATCH_SIZE = 10000
+
+
+def generate(engine, teams, players_per_team, users, seed=0):
+    '''
+    Fill an empty DB with a synthetic league.
+
+    @param engine: the engine of the DB to fill
+    @param teams: number of teams
+    @param players_per_team: number of players per team, at most 99
+        since jersey numbers are unique per team
+    @param users: number of users owning the players
+    @param seed: seed of the random generator
+    :returns: dict with the number of rows generated per table
+    '''
+    from db_setup import User, Team, Player
+    from sqlalchemy.orm import sessionmaker
+    from catalog import bump_catalog_version
+
+    if not (players_per_team >= 0 and players_per_team <= 99):
+        raise ValueError('players_per_team must be between 0 and 99')
+
+    rng = random.Random(seed)
+    positions = [p for p, weight in POSITION_WEIGHTS for _ in range(weight)]
+
+    session = sessionmaker(bind=engine)()
+    try:
+        session.execute(User.__table__.insert(), [
+            {'name': 'User {:06d}'.format(n),
+             'email': 'user{:06d}@example.com'.format(n)}
+            for n in range(1, users + 1)
+        ])
+        session.execute(Team.__table__.insert(), [
+            {'name': 'Team {:06d}'.format(n),
+             'nickname': 'team{:06d}'.format(n)}
+            for n in range(1, teams + 1)
+        ])
+        user_ids = [u for (u,) in session.query(User.id).order_by(User.id)]
+        team_ids = [t for (t,) in session.query(Team.id).order_by(Team.id)]
+
+        batch = []
+        for team_id in team_ids:
+            for jersey_number in rng.sample(range(1, 100), players_per_team):
+                batch.append({
+                    'name': '{} {}'.format(rng.choice(FIRST_NAMES),
+                                           rng.choice(LAST_NAMES)),
+                    'jersey_number': jersey_number,
+                    'position': rng.choice(positions),
+                    'team_id': team_id,
+                    'user_id': rng.choice(user_ids)
+                })
+                if len(batch) >= BATCH_SIZE:
+                    session.execute(Player.__table__.insert(), batch)
+                    batch = []
+        if batch:
+            session.execute(Player.__table__.insert(), batch)
+
+        bump_catalog_version(session)
+        session.commit()
+    finally:
+        session.close()
+
+    return {
+        'users': users,
+        'teams': teams,
+        'players': teams * players_per_team
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Generate a synthetic league into a scratch DB.')
+    parser.add_argument('--database-url', default='sqlite:///bench.db')
+    parser.add_argument('--teams', type=int, default=31)
+    parser.add_argument('--players-per-team', type=int, default=25)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    # config.py reads the environment at import time
+    os.environ['CATALOG_DATABASE_URL'] = args.database_url
+    from db_setup import setup_engine
+    engine = setup_engine()
+
+    counts = generate(engine, args.teams, args.players_per_team,
+                      args.users, args.seed)
+    print('Generated {users} users, {teams} teams, {players} players.'.format(
+        **counts))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+'''
+Worker scaling load test.
+
+Serves the app with gunicorn (see gunicorn.conf.py) at each of several
+worker counts in turn, loads it over HTTP with keep-alive client
+processes for a fixed time, and reports throughput and latency per
+worker count. Usage:
+
+    python3 league_gen.py --teams 100 --players-per-team 25
+    python3 loadtest.py --workers 1 2 4 8 --duration 20
+
+The requests are read-only: team and roster pages, catalog pages and
+players, by default against the scratch DB of league_gen.py. The client
+processes share the machine with the server, so leave them some CPU.
+'''
+from multiprocessing import Pool
+import argparse
+import http.client
+import os
+import socket
+import subprocess
+import sys
+import time
+
+
+def _wait_for_port(server, host, port, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline and server.poll() is None:
+        try:
+            socket.create_connection((host, port), 1).close()
+            return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+
+def _urls(database_url):
+    '''
+    Utility method: the URLs to request, built from the DB contents.
+    '''
+    os.environ['CATALOG_DATABASE_URL'] = database_url
+    from sqlalchemy.orm import sessionmaker
+    from db_setup import setup_engine, Team, Player
+
+    session = sessionmaker(bind=setup_engine())()
+    try:
+        nicknames = [n for (n,) in session.query(Team.nickname).order_by(
+            Team.id).limit(100)]
+        players = [p for (p,) in session.query(Player.id).order_by(
+            Player.id).limit(100)]
+    finally:
+        session.close()
+
+    urls = ['/teams/', '/api/v1/catalog.json?limit=500']
+    urls.extend('/teams/{}/players/'.format(n) for n in nicknames)
+    urls.extend('/api/v1/teams/{}/players'.format(n) for n in nicknames)
+    urls.extend('/api/v1/players/{}'.format(p) for p in players)
+    return urls
+
+
+def _client(job):
+    '''
+    Utility method: one client process, sending requests back to back on
+    a keep-alive connection until the deadline.
+
+    :returns: (latencies in seconds, error count) tuple
+    '''
+    host, port, urls, offset, deadline = job
+    connection = http.client.HTTPConnection(host, port, timeout=30)
+    latencies = []
+    errors = 0
+    i = offset
+    while time.time() < deadline:
+        url = urls[i % len(urls)]
+        i += 1
+        started = time.perf_counter()
+        try:
+            connection.request('GET', url)
+            response = connection.getresponse()
+            response.read()
+            if response.status != 200:
+                errors += 1
+        except (OSError, http.client.HTTPException):
+            errors += 1
+            connection.close()
+            connection = http.client.HTTPConnection(host, port, timeout=30)
+            continue
+        latencies.append(time.perf_counter() - started)
+    connection.close()
+    return (latencies, errors)
+
+
+def run(workers, threads, clients, duration, database_url, urls,
+        host='127.0.0.1', port=8765):
+    '''
+    Serve the app with a number of workers, and load it.
+
+    @param workers: gunicorn worker processes
+    @param threads: threads per worker
+    @param clients: concurrent client processes
+    @param duration: seconds of load
+    @param database_url: the DB to serve
+    @param urls: the URLs to request, in turn
+    :returns: dict of results
+    '''
+    env = dict(os.environ)
+    env.update({
+        'CATALOG_DATABASE_URL': database_url,
+        'CATALOG_SECRET_KEY': 'loadtest',
+        'CATALOG_WSGI_BIND': '{}:{}'.format(host, port),
+        'CATALOG_WSGI_WORKERS': str(workers),
+        'CATALOG_WSGI_THREADS': str(threads)
+    })
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py',
+         '--log-level', 'warning', 'wsgi:app'],
+        env=env, cwd=os.path.dirname(os.path.abspath(__file__)))
+    try:
+        if not _wait_for_port(server, host, port, 30):
+            raise RuntimeError('gunicorn did not start')
+        # warm every worker up: engines, caches, team registry
+        _client((host, port, urls, 0, time.time() + 2))
+
+        deadline = time.time() + duration
+        with Pool(clients) as pool:
+            samples = pool.map(_client, [
+                (host, port, urls, i * 7, deadline)
+                for i in range(clients)])
+    finally:
+        server.terminate()
+        server.wait()
+
+    latencies = sorted(
+        sample for latency, _ in samples for sample in latency)
+    errors = sum(e for _, e in samples)
+    return {
+        'workers': workers,
+        'requests': len(latencies),
+        'errors': errors,
+        'throughput_rps': len(latencies) / float(duration),
+        'p50_ms': _percentile(latencies, 50) * 1000,
+        'p95_ms': _percentile(latencies, 95) * 1000
+    }
+
+
+def _percentile(samples, pct):
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, int(len(samples) * pct / 100.0))]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Measure throughput against the gunicorn worker count.')
+    parser.add_argument('--database-url', default='sqlite:///bench.db')
+    parser.add_argument('--workers', type=int, nargs='+',
+                        default=[1, 2, 4])
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--clients', type=int, default=0,
+                        help='client processes (default: 2 per worker of '
+                        'the largest worker count)')
+    parser.add_argument('--duration', type=float, default=10)
+    args = parser.parse_args(argv)
+
+    urls = _urls(args.database_url)
+    clients = args.clients or 2 * max(args.workers)
+
+    sys.stdout.write('{} CPUs, {} client processes, {} threads per worker\n'
+                     .format(os.cpu_count(), clients, args.threads))
+    sys.stdout.write('{:>8}{:>10}{:>6}{:>10}{:>9}{:>10}{:>10}\n'.format(
+        'workers', 'requests', 'err', 'req/s', 'scaling', 'p50 ms',
+        'p95 ms'))
+    base = None
+    for workers in args.workers:
+        r = run(workers, args.threads, clients, args.duration,
+                args.database_url, urls)
+        base = base or r['throughput_rps']
+        sys.stdout.write(
+            '{:>8}{:>10}{:>6}{:>10.1f}{:>8.2f}x{:>10.2f}{:>10.2f}\n'.format(
+                workers, r['requests'], r['errors'], r['throughput_rps'],
+                r['throughput_rps'] / base if base else 0.0, r['p50_ms'],
+                r['p95_ms']))
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
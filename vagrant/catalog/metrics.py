@@ -0,0 +1,334 @@
+'''
+Request instrumentation.
+
+Times every request, and the parts of it spent running SQL, rendering
+templates and cleaning user input with bleach, and exposes the results
+in the Prometheus text format. Requests slower than SLOW_REQUEST_MS are
+logged along with the SQL they ran.
+'''
+from contextlib import contextmanager
+from flask import g, has_app_context, request, Response
+from flask import before_render_template, template_rendered
+from flask.signals import signals_available
+from sqlalchemy import event
+import config
+import threading
+import time
+
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+# SQL statements longer than this are cut short in the slow request log
+SLOW_LOG_STATEMENT_LENGTH = 500
+
+
+class Histogram(object):
+    '''
+    Cumulative histogram, one series per label values tuple.
+    '''
+
+    def __init__(self, name, documentation, labels, buckets):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label_values, value):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = \
+                    [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def expose(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation),
+                 '# TYPE {} histogram'.format(self.name)]
+        with self._lock:
+            for label_values, (counts, total, count) in sorted(
+                    self._series.items()):
+                labels = _labels(self.labels, label_values)
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append('{}_bucket{{{}le="{}"}} {}'.format(
+                        self.name, labels + ',' if labels else '',
+                        _number(bound), bucket_count))
+                lines.append('{}_bucket{{{}le="+Inf"}} {}'.format(
+                    self.name, labels + ',' if labels else '', count))
+                lines.append('{}_sum{} {}'.format(
+                    self.name, _braces(labels), _number(total)))
+                lines.append('{}_count{} {}'.format(
+                    self.name, _braces(labels), count))
+        return lines
+
+
+class Counter(object):
+    '''
+    Monotonic counter, one series per label values tuple.
+    '''
+
+    def __init__(self, name, documentation, labels):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def inc(self, label_values, value=1):
+        with self._lock:
+            self._series[label_values] = \
+                self._series.get(label_values, 0) + value
+
+    def expose(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation),
+                 '# TYPE {} counter'.format(self.name)]
+        with self._lock:
+            for label_values, value in sorted(self._series.items()):
+                lines.append('{}{} {}'.format(
+                    self.name,
+                    _braces(_labels(self.labels, label_values)),
+                    _number(value)))
+        return lines
+
+
+def _labels(names, values):
+    return ','.join('{}="{}"'.format(
+        name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for name, value in zip(names, values))
+
+
+def _braces(labels):
+    return '{' + labels + '}' if labels else ''
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+REQUESTS = Counter(
+    'catalog_requests_total', 'Requests served.',
+    ('endpoint', 'method', 'status'))
+REQUEST_DURATION = Histogram(
+    'catalog_request_duration_seconds', 'Time to serve a request.',
+    ('endpoint',), LATENCY_BUCKETS)
+SECTION_DURATION = Histogram(
+    'catalog_request_section_seconds',
+    'Time a request spent in SQL, template rendering or bleach.',
+    ('endpoint', 'section'), LATENCY_BUCKETS)
+SQL_QUERIES = Histogram(
+    'catalog_sql_queries_per_request', 'SQL statements run per request.',
+    ('endpoint',), COUNT_BUCKETS)
+TEMPLATE_DURATION = Histogram(
+    'catalog_template_render_seconds', 'Time to render a template.',
+    ('template',), LATENCY_BUCKETS)
+
+METRICS = [REQUESTS, REQUEST_DURATION, SECTION_DURATION, SQL_QUERIES,
+           TEMPLATE_DURATION]
+_collectors = []
+
+
+def register_collector(collect):
+    '''
+    Add metrics computed at exposition time, e.g. cache statistics.
+
+    @param collect: callable returning a list of exposition lines
+    '''
+    _collectors.append(collect)
+
+
+def cache_collector(name, stats):
+    '''
+    Build a collector for a cache exposing hits, misses and size.
+
+    @param name: the cache name, used as the metric name prefix
+    @param stats: callable returning a dict with hits, misses and size
+    :returns: the collector, see register_collector()
+    '''
+    def collect():
+        values = stats()
+        return [
+            '# HELP catalog_{}_hits_total Lookups served by the {}.'.format(
+                name, name.replace('_', ' ')),
+            '# TYPE catalog_{}_hits_total counter'.format(name),
+            'catalog_{}_hits_total {}'.format(name, values['hits']),
+            '# HELP catalog_{}_misses_total Lookups missing the {}.'.format(
+                name, name.replace('_', ' ')),
+            '# TYPE catalog_{}_misses_total counter'.format(name),
+            'catalog_{}_misses_total {}'.format(name, values['misses']),
+            '# HELP catalog_{}_size Entries held by the {}.'.format(
+                name, name.replace('_', ' ')),
+            '# TYPE catalog_{}_size gauge'.format(name),
+            'catalog_{}_size {}'.format(name, values['size'])
+        ]
+    return collect
+
+
+def expose():
+    '''
+    :returns: every metric in the Prometheus text format
+    '''
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.expose())
+    for collect in _collectors:
+        lines.extend(collect())
+    return '\n'.join(lines) + '\n'
+
+
+def _current():
+    if has_app_context():
+        return g.get('_metrics')
+    return None
+
+
+def add_section_time(section, elapsed):
+    '''
+    Charge time to a section of the current request, if any.
+
+    @param section: the section name, e.g. 'sql'
+    @param elapsed: the time spent, in seconds
+    '''
+    current = _current()
+    if current is not None:
+        sections = current['sections']
+        sections[section] = sections.get(section, 0.0) + elapsed
+
+
+@contextmanager
+def timer(section):
+    '''
+    Context manager charging the time spent in its block to a section of
+    the current request.
+
+    @param section: the section name, e.g. 'bleach'
+    '''
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_section_time(section, time.perf_counter() - started)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    context._metrics_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    elapsed = time.perf_counter() - context._metrics_started
+    current = _current()
+    if current is None:
+        return
+    current['queries'] += 1
+    add_section_time('sql', elapsed)
+    if current['statements'] is not None:
+        current['statements'].append((elapsed, statement, parameters))
+
+
+def _before_render_template(sender, template, context, **extra):
+    current = _current()
+    if current is not None:
+        current['templates'].append(time.perf_counter())
+
+
+def _template_rendered(sender, template, context, **extra):
+    current = _current()
+    if current is not None and current['templates']:
+        elapsed = time.perf_counter() - current['templates'].pop()
+        TEMPLATE_DURATION.observe((template.name,), elapsed)
+        add_section_time('template', elapsed)
+
+
+def _record(app, endpoint, method, status, started, current, slow_ms):
+    elapsed = time.perf_counter() - started
+    REQUESTS.inc((endpoint, method, status))
+    REQUEST_DURATION.observe((endpoint,), elapsed)
+    SQL_QUERIES.observe((endpoint,), current['queries'])
+    for section, section_elapsed in current['sections'].items():
+        SECTION_DURATION.observe((endpoint, section), section_elapsed)
+
+    if current['statements'] is not None and \
+            elapsed * 1000 >= slow_ms:
+        lines = ['Slow request: {} {} took {:.1f} ms, {} SQL statements:'
+                 .format(method, current['path'], elapsed * 1000,
+                         current['queries'])]
+        for sql_elapsed, statement, parameters in current['statements']:
+            lines.append('  {:.1f} ms: {} {!r}'.format(
+                sql_elapsed * 1000,
+                ' '.join(statement.split())[:SLOW_LOG_STATEMENT_LENGTH],
+                parameters))
+        app.logger.warning('\n'.join(lines))
+
+
+def instrument_engine(engine):
+    '''
+    Time the SQL statements run by a DB engine.
+
+    @param engine: the DB engine
+    '''
+    event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+
+
+def init_app(app, settings=config):
+    '''
+    Instrument the app and add the /metrics route. The DB engine is
+    instrumented separately, see instrument_engine().
+
+    @param app: the Flask app
+    @param settings: object holding the settings, see config.py
+    '''
+    slow_ms = settings.SLOW_REQUEST_MS
+
+    if signals_available:
+        before_render_template.connect(_before_render_template, app)
+        template_rendered.connect(_template_rendered, app)
+    else:
+        app.logger.warning('blinker is not installed, '
+                           'template rendering will not be timed.')
+
+    @app.before_request
+    def start_request_metrics():
+        g._metrics = {
+            'started': time.perf_counter(),
+            'path': request.path,
+            'queries': 0,
+            'sections': {},
+            'templates': [],
+            'statements': [] if slow_ms else None
+        }
+
+    @app.after_request
+    def finish_request_metrics(response):
+        current = g.get('_metrics')
+        if current is None:
+            return response
+        endpoint = request.endpoint or 'none'
+        method = request.method
+        status = response.status_code
+        if response.is_streamed:
+            # streamed responses are only done once the server closes them
+            response.call_on_close(lambda: _record(
+                app, endpoint, method, status, current['started'], current,
+                slow_ms))
+        else:
+            _record(app, endpoint, method, status, current['started'],
+                    current, slow_ms)
+        return response
+
+    @app.route('/metrics')
+    def show_metrics():
+        '''
+        metrics route
+        Expose the metrics in the Prometheus text format.
+
+        :returns: text/plain metrics
+        '''
+        return Response(expose(), mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,275 @@
+from contextlib import contextmanager
+from sqlalchemy import inspect, text, Integer
+from sqlalchemy.exc import OperationalError
+import config
+import sys
+
+
+def _index_hot_columns(connection):
+    '''
+    Index the columns used by the roster and user lookups.
+    Fails with an IntegrityError if a team already has two players
+    wearing the same jersey number; fix those rows and re-run.
+    '''
+    connection.execute(text(
+        'CREATE UNIQUE INDEX IF NOT EXISTS ix_player_team_jersey '
+        'ON player (team_id, jersey_number)'))
+    connection.execute(text(
+        'CREATE INDEX IF NOT EXISTS ix_player_user_id '
+        'ON player (user_id)'))
+    connection.execute(text(
+        'CREATE INDEX IF NOT EXISTS ix_user_email '
+        'ON "user" (email)'))
+
+
+# frozen copy of db_setup.POSITIONS, whose indexes are the stored codes
+_POSITIONS = ('Goaltender', 'Defenceman', 'Offenceman')
+# the FTS triggers of migration 2
+_PLAYER_FTS_TRIGGERS = ('player_fts_insert', 'player_fts_update',
+                        'player_fts_delete', 'player_fts_team_update')
+
+
+def _position_name(column):
+    '''
+    Utility method: SQL expression turning a position code back into its
+    name. Position names stored before migration 3 pass through as is.
+    '''
+    return 'CASE {} {} ELSE {} END'.format(column, ' '.join(
+        "WHEN {} THEN '{}'".format(code, name)
+        for code, name in enumerate(_POSITIONS)), column)
+
+
+def _create_player_fts_triggers(connection):
+    '''
+    Utility method: keep player_fts in sync with the player and team
+    tables.
+    '''
+    connection.execute(text(
+        'CREATE TRIGGER IF NOT EXISTS player_fts_insert '
+        'AFTER INSERT ON player BEGIN '
+        'INSERT INTO player_fts (rowid, name, position, team) '
+        'VALUES (new.id, new.name, {}, '
+        '(SELECT name FROM team WHERE id = new.team_id)); '
+        'END'.format(_position_name('new.position'))))
+    connection.execute(text(
+        'CREATE TRIGGER IF NOT EXISTS player_fts_update '
+        'AFTER UPDATE OF name, position, team_id ON player BEGIN '
+        'DELETE FROM player_fts WHERE rowid = old.id; '
+        'INSERT INTO player_fts (rowid, name, position, team) '
+        'VALUES (new.id, new.name, {}, '
+        '(SELECT name FROM team WHERE id = new.team_id)); '
+        'END'.format(_position_name('new.position'))))
+    connection.execute(text(
+        'CREATE TRIGGER IF NOT EXISTS player_fts_delete '
+        'AFTER DELETE ON player BEGIN '
+        'DELETE FROM player_fts WHERE rowid = old.id; '
+        'END'))
+    connection.execute(text(
+        'CREATE TRIGGER IF NOT EXISTS player_fts_team_update '
+        'AFTER UPDATE OF name ON team BEGIN '
+        'UPDATE player_fts SET team = new.name WHERE rowid IN '
+        '(SELECT id FROM player WHERE team_id = new.id); '
+        'END'))
+
+
+def _rebuild_player_fts(connection):
+    '''
+    Utility method: refill player_fts from the player table.
+    '''
+    connection.execute(text('DELETE FROM player_fts'))
+    connection.execute(text(
+        'INSERT INTO player_fts (rowid, name, position, team) '
+        'SELECT player.id, player.name, {}, team.name '
+        'FROM player LEFT OUTER JOIN team ON team.id = player.team_id'
+        .format(_position_name('player.position'))))
+
+
+def _has_player_fts(connection):
+    return connection.execute(text(
+        "SELECT 1 FROM sqlite_master "
+        "WHERE type = 'table' AND name = 'player_fts'")).scalar() is not None
+
+
+def _player_search_index(connection):
+    '''
+    Add the player_fts full-text index of player names, positions and
+    team names, kept in sync with the player and team tables by triggers,
+    along with the player_fts_vocab table of its terms used for fuzzy
+    matching. The index is rebuilt from the player table.
+    SQLite only, and only if it was built with FTS5; search.py falls back
+    to plain LIKE matching otherwise.
+    '''
+    if connection.dialect.name != 'sqlite':
+        return
+    try:
+        connection.execute(text(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS player_fts USING fts5 "
+            "(name, position, team, prefix='1 2 3')"))
+    except OperationalError:
+        # no such module: fts5
+        return
+    connection.execute(text(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS player_fts_vocab "
+        "USING fts5vocab(player_fts, 'row')"))
+
+    _create_player_fts_triggers(connection)
+    _rebuild_player_fts(connection)
+
+
+def _enumerate_positions(connection):
+    '''
+    Store player positions as small integer codes, the index of the
+    position in db_setup.POSITIONS, checked to be one of those, and
+    index rosters by team, position and jersey number.
+    Fails with a ValueError, before changing anything, if a player has a
+    position that is not one of POSITIONS; fix those rows and re-run.
+    SQLite cannot change a column type, so there the player table is
+    rebuilt, and the player_fts triggers are recreated with it.
+    '''
+    columns = dict((column['name'], column['type'])
+                   for column in inspect(connection).get_columns('player'))
+    if not isinstance(columns['position'], Integer):
+        unknown = [row[0] for row in connection.execute(text(
+            'SELECT id FROM player WHERE position IS NULL '
+            'OR position NOT IN ({}) ORDER BY id'.format(', '.join(
+                "'{}'".format(name) for name in _POSITIONS))))]
+        if unknown:
+            raise ValueError(
+                'Players with an unknown position: {}; set their position '
+                'to one of {} and re-run.'.format(
+                    ', '.join(str(i) for i in unknown),
+                    ', '.join(_POSITIONS)))
+        codes = 'CASE position {} END'.format(' '.join(
+            "WHEN '{}' THEN {}".format(name, code)
+            for code, name in enumerate(_POSITIONS)))
+        check = 'position >= 0 AND position < {}'.format(len(_POSITIONS))
+        if connection.dialect.name == 'sqlite':
+            fts = _has_player_fts(connection)
+            for trigger in _PLAYER_FTS_TRIGGERS:
+                connection.execute(text(
+                    'DROP TRIGGER IF EXISTS {}'.format(trigger)))
+            # left behind by a failed run of an earlier version of this
+            connection.execute(text('DROP TABLE IF EXISTS player_new'))
+            connection.execute(text(
+                'CREATE TABLE player_new ('
+                'id INTEGER NOT NULL, '
+                'name VARCHAR(50) NOT NULL, '
+                'jersey_number INTEGER NOT NULL, '
+                'position SMALLINT NOT NULL, '
+                'team_id INTEGER, '
+                'user_id INTEGER, '
+                'PRIMARY KEY (id), '
+                'CONSTRAINT ck_player_position CHECK ({}), '
+                'FOREIGN KEY(team_id) REFERENCES team (id), '
+                'FOREIGN KEY(user_id) REFERENCES user (id))'.format(check)))
+            connection.execute(text(
+                'INSERT INTO player_new '
+                '(id, name, jersey_number, position, team_id, user_id) '
+                'SELECT id, name, jersey_number, {}, team_id, user_id '
+                'FROM player'.format(codes)))
+            connection.execute(text('DROP TABLE player'))
+            connection.execute(text(
+                'ALTER TABLE player_new RENAME TO player'))
+            _index_hot_columns(connection)
+            if fts:
+                _create_player_fts_triggers(connection)
+                _rebuild_player_fts(connection)
+        else:
+            connection.execute(text(
+                'ALTER TABLE player ALTER COLUMN position TYPE SMALLINT '
+                'USING {}'.format(codes)))
+            connection.execute(text(
+                'ALTER TABLE player ADD CONSTRAINT ck_player_position '
+                'CHECK ({})'.format(check)))
+
+    connection.execute(text(
+        'CREATE INDEX IF NOT EXISTS ix_player_team_position_jersey '
+        'ON player (team_id, position, jersey_number)'))
+
+
+# (version, description, migration) in the order they must be applied.
+# Migrations must be idempotent: a freshly created DB already has the
+# latest schema from db_setup, and runs every migration once anyway.
+MIGRATIONS = [
+    (1, 'index hot lookup columns', _index_hot_columns),
+    (2, 'full-text index of players', _player_search_index),
+    (3, 'enumerate player positions', _enumerate_positions),
+]
+
+
+def get_schema_version(connection):
+    '''
+    Read the schema version of the DB, creating its table if needed.
+
+    @param connection: an open DB connection
+    :returns: the version of the last applied migration, 0 if none
+    '''
+    connection.execute(text(
+        'CREATE TABLE IF NOT EXISTS schema_version '
+        '(version INTEGER NOT NULL)'))
+    version = connection.execute(text(
+        'SELECT version FROM schema_version')).scalar()
+    if version is None:
+        connection.execute(text(
+            'INSERT INTO schema_version (version) VALUES (0)'))
+        version = 0
+
+    return version
+
+
+@contextmanager
+def _transaction(engine):
+    '''
+    Utility method: open a connection in a transaction that covers DDL,
+    committed if the block succeeds and rolled back otherwise.
+    pysqlite only begins a transaction before an INSERT, UPDATE or
+    DELETE, so DDL ahead of one would not be rolled back; on SQLite its
+    transaction handling is turned off and the transaction begun here.
+    '''
+    with engine.connect() as connection:
+        if connection.dialect.name != 'sqlite':
+            with connection.begin():
+                yield connection
+            return
+
+        dbapi_connection = connection.connection.connection
+        isolation_level = dbapi_connection.isolation_level
+        dbapi_connection.isolation_level = None
+        try:
+            with connection.begin():
+                connection.execute(text('BEGIN'))
+                yield connection
+        finally:
+            dbapi_connection.isolation_level = isolation_level
+
+
+def upgrade(engine):
+    '''
+    Apply every pending migration, each in its own transaction, so a
+    failed migration leaves the DB as it was.
+
+    @param engine: the engine of the DB to upgrade
+    :returns: the schema version after the upgrade
+    '''
+    with _transaction(engine) as connection:
+        version = get_schema_version(connection)
+
+    for target, description, migration in MIGRATIONS:
+        if target <= version:
+            continue
+        with _transaction(engine) as connection:
+            migration(connection)
+            connection.execute(text(
+                'UPDATE schema_version SET version = :version'),
+                version=target)
+        version = target
+
+    return version
+
+
+if __name__ == '__main__':
+    # creates the missing tables too, so this also sets up a new DB
+    from db_setup import create_schema, make_engine
+    url = sys.argv[1] if len(sys.argv) > 1 else config.DATABASE_URL
+    print('Schema is at version {}.'.format(
+        create_schema(make_engine(url=url))))
@@ -0,0 +1,124 @@
+from collections import OrderedDict
+from sqlalchemy import event
+from db_setup import Team
+import config
+import threading
+import time
+
+
+class PageCache(object):
+    '''
+    Bounded LRU cache of rendered pages, keyed by (view, team nickname).
+    Entries of a team are dropped by invalidate_team() whenever one of
+    its players changes. Each team also has a generation number, bumped
+    on invalidation, so a page rendered while a write was committing is
+    never stored over the invalidation.
+    Entries are tagged with the catalog version they were rendered at,
+    and a lookup at another version is a miss, so writes made by other
+    processes, which bump the version, invalidate entries too.
+    '''
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._generations = {}
+        self._epoch = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def configure(self, max_entries, ttl):
+        '''
+        Change the size cap and the TTL, dropping every page.
+
+        @param max_entries: the most pages kept
+        @param ttl: seconds a page is kept
+        '''
+        with self._lock:
+            self.max_entries = max_entries
+            self.ttl = ttl
+        self.clear()
+
+    def get(self, key, version):
+        '''
+        Look a page up.
+
+        @param key: (view name, team nickname or None) tuple
+        @param version: the current catalog version
+        :returns: (page, generation) tuple; page is None on a miss, and
+            generation must be handed back to set()
+        '''
+        with self._lock:
+            generation = self._generation(key[1])
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > time.time() and \
+                    entry[2] == version:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return (entry[0], generation)
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return (None, generation)
+
+    def set(self, key, page, generation, version):
+        '''
+        Store a page, evicting the least recently used one if full.
+
+        @param key: (view name, team nickname or None) tuple
+        @param page: the rendered page
+        @param generation: the generation returned by get()
+        @param version: the catalog version the page was rendered at
+        '''
+        with self._lock:
+            if self._generation(key[1]) != generation:
+                return
+            self._entries[key] = (page, time.time() + self.ttl, version)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate_team(self, team_nickname):
+        '''
+        Drop every page of a team.
+
+        @param team_nickname: the nickname of the changed team
+        '''
+        with self._lock:
+            self._generations[team_nickname] = \
+                self._generations.get(team_nickname, 0) + 1
+            for key in [k for k in self._entries if k[1] == team_nickname]:
+                del self._entries[key]
+
+    def clear(self):
+        '''
+        Drop every page.
+        '''
+        with self._lock:
+            self._epoch += 1
+            self._generations.clear()
+            self._entries.clear()
+
+    def _generation(self, team_nickname):
+        return (self._epoch, self._generations.get(team_nickname, 0))
+
+    def stats(self):
+        '''
+        :returns: dict with the hit and miss counts and the cache size
+        '''
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._entries)
+        }
+
+
+page_cache = PageCache(config.PAGE_CACHE_MAX_ENTRIES, config.PAGE_CACHE_TTL)
+
+
+@event.listens_for(Team, 'after_insert')
+@event.listens_for(Team, 'after_update')
+@event.listens_for(Team, 'after_delete')
+def _clear_page_cache(mapper, connection, target):
+    page_cache.clear()
@@ -0,0 +1,258 @@
+'''
+Batched player mutations.
+
+Validates a list of create, update and delete operations on players as a
+whole, and applies them in one transaction with a handful of bulk
+statements. Operations look like:
+
+    {"op": "create", "team": "predators", "name": "Pekka Rinne",
+     "jersey_number": 35, "position": "Goaltender"}
+    {"op": "update", "id": 42, "jersey_number": 9, "team": "islanders"}
+    {"op": "delete", "id": 43}
+
+An update changes only the fields it names; changing the team is a trade.
+Jersey numbers are checked against the rosters as they stand once the
+whole batch is applied, so two players can swap numbers in one batch.
+'''
+from sqlalchemy import bindparam
+from db_setup import Player, POSITIONS
+from catalog import bump_catalog_version
+from changes import record_changes, created_players
+from team_registry import team_registry
+import bleach
+
+
+# most operations accepted in one batch
+BATCH_MAX_OPERATIONS = 500
+
+OPERATIONS = ('create', 'update', 'delete')
+
+
+class RejectedOperation(Exception):
+    pass
+
+
+class PlayerBatch(object):
+    '''
+    A batch of player operations made on behalf of one user, who may only
+    update and delete their own players.
+    '''
+
+    def __init__(self, session, user_id, clean=bleach.clean):
+        '''
+        @param session: the DB session to apply the batch with
+        @param user_id: the id of the user making the changes
+        @param clean: function sanitizing user-supplied text
+        '''
+        self.session = session
+        self.user_id = user_id
+        self.clean = clean
+        self.creates = []
+        self.updates = []
+        self.deletes = []
+        self.team_ids = set()
+
+    def validate(self, operations):
+        '''
+        Validate every operation of the batch.
+
+        @param operations: list of operation dicts
+        :returns: list of (index, error message) tuples, empty if the
+            whole batch is valid
+        '''
+        errors = []
+        ids = [op.get('id') for op in operations
+               if isinstance(op, dict) and op.get('op') in ('update',
+                                                            'delete')]
+        # bools are ints too, see _validate_operation()
+        ids = [i for i in ids if type(i) is int]
+        players = dict((row[0], row) for row in self.session.query(
+            Player.id, Player.name, Player.jersey_number, Player.position,
+            Player.team_id, Player.user_id
+        ).filter(Player.id.in_(ids))) if ids else {}
+
+        seen = set()
+        for index, op in enumerate(operations):
+            try:
+                self._validate_operation(index, op, players, seen)
+            except RejectedOperation as e:
+                errors.append((index, str(e)))
+
+        errors.extend(self._jersey_conflicts())
+        return sorted(errors)
+
+    def apply(self):
+        '''
+        Apply the validated batch to the session. Deletes go first, then
+        updates, then creates. Updated players moving to another number
+        are first parked on a number no player can hold, so a swap never
+        trips the team/jersey unique index half-way. Every change is
+        logged, see changes.py. The caller commits.
+
+        :returns: list of per-operation result dicts, in batch order
+        '''
+        table = Player.__table__
+        results = []
+        if not (self.deletes or self.updates or self.creates):
+            return results
+        bump_catalog_version(self.session)
+
+        if self.deletes:
+            self.session.execute(table.delete().where(
+                table.c.id.in_([d['id'] for _, d in self.deletes])))
+            record_changes(
+                self.session, 'delete', [d for _, d in self.deletes])
+            results.extend(
+                {'index': i, 'status': 'deleted', 'id': d['id']}
+                for i, d in self.deletes)
+
+        if self.updates:
+            moving = [{'_id': u['id'], '_parked': -u['id']}
+                      for _, u in self.updates if u['moving']]
+            if moving:
+                self.session.execute(table.update().where(
+                    table.c.id == bindparam('_id')
+                ).values(jersey_number=bindparam('_parked')), moving)
+            self.session.execute(table.update().where(
+                table.c.id == bindparam('_id')
+            ).values(
+                name=bindparam('_name'),
+                jersey_number=bindparam('_jersey_number'),
+                position=bindparam('_position'),
+                team_id=bindparam('_team_id')
+            ), [{
+                '_id': u['id'],
+                '_name': u['name'],
+                '_jersey_number': u['jersey_number'],
+                '_position': u['position'],
+                '_team_id': u['team_id']
+            } for _, u in self.updates])
+            record_changes(self.session, 'update', [dict(
+                u, user_id=self.user_id) for _, u in self.updates])
+            results.extend(
+                {'index': i, 'status': 'updated', 'id': u['id']}
+                for i, u in self.updates)
+
+        if self.creates:
+            self.session.execute(
+                table.insert(), [c for _, c in self.creates])
+            created = created_players(
+                self.session, [c for _, c in self.creates])
+            record_changes(self.session, 'create', [
+                created[(c['team_id'], c['jersey_number'])]
+                for _, c in self.creates])
+            results.extend({
+                'index': i,
+                'status': 'created',
+                'id': created[(c['team_id'], c['jersey_number'])]['id']
+            } for i, c in self.creates)
+
+        return sorted(results, key=lambda result: result['index'])
+
+    def _validate_operation(self, index, op, players, seen):
+        if not isinstance(op, dict) or op.get('op') not in OPERATIONS:
+            raise RejectedOperation(
+                'op must be one of: {}'.format(', '.join(OPERATIONS)))
+
+        if op['op'] == 'create':
+            team_id = self._team_id(op.get('team'))
+            self.creates.append((index, {
+                'name': self._name(op.get('name')),
+                'jersey_number': self._jersey_number(op.get('jersey_number')),
+                'position': self._position(op.get('position')),
+                'team_id': team_id,
+                'user_id': self.user_id
+            }))
+            self.team_ids.add(team_id)
+            return
+
+        # True would pass for player 1, and lists cannot be looked up
+        if type(op.get('id')) is not int:
+            raise RejectedOperation('id must be an integer')
+        player = players.get(op['id'])
+        if player is None:
+            raise RejectedOperation('unknown player')
+        if player.user_id != self.user_id:
+            raise RejectedOperation('not authorized to change this player')
+        if player.id in seen:
+            raise RejectedOperation('player changed twice in one batch')
+        seen.add(player.id)
+        self.team_ids.add(player.team_id)
+
+        if op['op'] == 'delete':
+            self.deletes.append((index, {'id': player.id,
+                                         'team_id': player.team_id}))
+            return
+
+        update = {
+            'id': player.id,
+            'name': self._name(op['name']) if 'name' in op
+            else player.name,
+            'jersey_number': self._jersey_number(op['jersey_number'])
+            if 'jersey_number' in op else player.jersey_number,
+            'position': self._position(op['position']) if 'position' in op
+            else player.position,
+            'team_id': self._team_id(op['team']) if 'team' in op
+            else player.team_id
+        }
+        update['moving'] = (update['team_id'], update['jersey_number']) != \
+            (player.team_id, player.jersey_number)
+        self.updates.append((index, update))
+        self.team_ids.add(update['team_id'])
+
+    def _jersey_conflicts(self):
+        '''
+        Utility method: check the jersey numbers of the rosters touched by
+        the batch, as they will be once it is applied.
+
+        :returns: list of (index, error message) tuples
+        '''
+        if not self.creates and not self.updates:
+            return []
+
+        changed = set(u['id'] for _, u in self.updates) | \
+            set(d['id'] for _, d in self.deletes)
+        # (team id, jersey number) -> index of the operation claiming
+        # it, or None for a player the batch leaves alone
+        claims = dict(
+            ((team_id, jersey_number), None)
+            for player_id, team_id, jersey_number in self.session.query(
+                Player.id, Player.team_id, Player.jersey_number
+            ).filter(Player.team_id.in_(self.team_ids))
+            if player_id not in changed)
+
+        errors = []
+        for index, player in sorted(self.updates + self.creates):
+            key = (player['team_id'], player['jersey_number'])
+            if key in claims:
+                errors.append((index, 'jersey number {} already taken'
+                               .format(player['jersey_number'])))
+            else:
+                claims[key] = index
+        return errors
+
+    def _team_id(self, nickname):
+        team = team_registry.by_nickname(self.session, nickname) \
+            if isinstance(nickname, str) else None
+        if team is None:
+            raise RejectedOperation('unknown team')
+        return team.id
+
+    def _name(self, name):
+        name = self.clean(name).strip() if isinstance(name, str) else ''
+        if not name or len(name) > 50:
+            raise RejectedOperation('player name must be 1-50 characters')
+        return name
+
+    def _jersey_number(self, jersey_number):
+        if isinstance(jersey_number, bool) or \
+                not isinstance(jersey_number, int):
+            raise RejectedOperation('jersey number must be an integer')
+        if not (jersey_number > 0 and jersey_number < 100):
+            raise RejectedOperation('jersey number must be between 1 and 99')
+        return jersey_number
+
+    def _position(self, position):
+        if position not in POSITIONS:
+            raise RejectedOperation('unknown position')
+        return position
@@ -0,0 +1,104 @@
+'''
+Read-only records.
+
+Immutable, __slots__-based copies of team and player rows, filled from
+Core selects for the pages and API endpoints that only read. They skip
+the ORM's identity map, instance state and relationship loading, and
+serialize the same way as the mapped classes.
+'''
+from collections import namedtuple
+from sqlalchemy import select
+from db_setup import Team, Player
+
+
+team_table = Team.__table__
+player_table = Player.__table__
+
+
+class TeamRecord(namedtuple('TeamRecord', ['id', 'name', 'nickname'])):
+    '''
+    Immutable, detached copy of a Team row.
+    '''
+    __slots__ = ()
+
+    @property
+    def serialize(self):
+        """Return object data in easily serializeable format."""
+        return {
+            'id': self.id,
+            'name': self.name,
+            'nickname': self.nickname
+        }
+
+
+class PlayerRecord(namedtuple('PlayerRecord', [
+        'id', 'name', 'jersey_number', 'position', 'team_id',
+        'user_id'])):
+    '''
+    Immutable, detached copy of a Player row.
+    '''
+    __slots__ = ()
+
+    @property
+    def serialize(self):
+        """Return object data in easily serializeable format."""
+        return {
+            'id': self.id,
+            'name': self.name,
+            'jersey_number': self.jersey_number,
+            'position': self.position,
+            'team_id': self.team_id,
+            'user_id': self.user_id
+        }
+
+
+# Core selects of the record columns, in record field order
+TEAM_COLUMNS = [team_table.c.id, team_table.c.name, team_table.c.nickname]
+PLAYER_COLUMNS = [
+    player_table.c.id,
+    player_table.c.name,
+    player_table.c.jersey_number,
+    player_table.c.position,
+    player_table.c.team_id,
+    player_table.c.user_id
+]
+
+
+def teams(session):
+    '''
+    Read every team, by name.
+
+    @param session: the DB session to run the select with
+    :returns: list of TeamRecord
+    '''
+    return [TeamRecord(*row) for row in session.execute(
+        select(TEAM_COLUMNS).order_by(team_table.c.name))]
+
+
+def roster(session, team_id):
+    '''
+    Read a team's players, by position, then jersey number.
+
+    @param session: the DB session to run the select with
+    @param team_id: the id of the team
+    :returns: list of PlayerRecord
+    '''
+    return [PlayerRecord(*row) for row in session.execute(
+        select(PLAYER_COLUMNS).where(
+            player_table.c.team_id == team_id
+        ).order_by(
+            player_table.c.position, player_table.c.jersey_number
+        ))]
+
+
+def player(session, player_id):
+    '''
+    Read one player.
+
+    @param session: the DB session to run the select with
+    @param player_id: the id of the player
+    :returns: the PlayerRecord, or None if there is no such player
+    '''
+    row = session.execute(select(PLAYER_COLUMNS).where(
+        player_table.c.id == player_id)).first()
+    return PlayerRecord(*row) if row is not None else None
@@ -0,0 +1,70 @@
+'''
+SQLite read replicas.
+
+Keeps copies of the SQLite DB up to date with the online backup API, so
+the replica routing of database.py can be run and tried without a DB
+server. Every interval the primary is copied into each replica file in
+one step, while the app keeps reading from it. Usage:
+
+    python3 replica_sync.py --replica replica1.db --replica replica2.db
+    CATALOG_DATABASE_REPLICA_URLS=sqlite:///replica1.db,\
+sqlite:///replica2.db python3 server.py
+
+Replicas lag the primary by up to the interval, so keep it below
+config.READ_YOUR_WRITES_SECONDS. Needs Python 3.7 or later.
+'''
+from sqlalchemy.engine.url import make_url
+import argparse
+import config
+import sqlite3
+import sys
+import time
+
+
+def copy(primary, replica):
+    '''
+    Copy the primary DB into a replica file, in one step, so readers of
+    the replica see either the old copy or the new one.
+
+    @param primary: path of the primary DB file
+    @param replica: path of the replica DB file
+    '''
+    source = sqlite3.connect(primary)
+    try:
+        target = sqlite3.connect(replica)
+        try:
+            source.backup(target)
+        finally:
+            target.close()
+    finally:
+        source.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Refresh SQLite read replicas from the primary DB.')
+    parser.add_argument('--primary',
+                        default=make_url(config.DATABASE_URL).database,
+                        help='primary DB file (default: from the settings)')
+    parser.add_argument('--replica', action='append', required=True,
+                        help='replica DB file, may be repeated')
+    parser.add_argument('--interval', type=float, default=5,
+                        help='seconds between refreshes')
+    parser.add_argument('--once', action='store_true',
+                        help='refresh once and exit')
+    args = parser.parse_args(argv)
+
+    while True:
+        started = time.time()
+        for replica in args.replica:
+            copy(args.primary, replica)
+        sys.stdout.write('Refreshed {} replica(s) in {:.1f} ms\n'.format(
+            len(args.replica), (time.time() - started) * 1000))
+        sys.stdout.flush()
+        if args.once:
+            return
+        time.sleep(max(0, args.interval - (time.time() - started)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+'''
+Read replicas.
+
+Engines for the replica DBs of config.DATABASE_REPLICA_URLS, taken in
+turn for the reads of a request, see database.py. A replica that fails
+to connect, or that does not hold the catalog, is marked down and left
+alone for config.REPLICA_RETRY_SECONDS; reads go to the other replicas,
+or to the primary when none is up.
+'''
+from sqlalchemy import event
+from sqlalchemy.exc import DBAPIError
+from db_setup import make_engine
+import config
+import itertools
+import logging
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class ReplicaUnavailable(Exception):
+    '''
+    Raised when a replica DB does not hold the catalog.
+    '''
+
+
+def _check_catalog(dbapi_connection, connection_record):
+    '''
+    Utility method: make sure a new replica connection holds the catalog.
+    Connecting to a missing SQLite file creates an empty DB rather than
+    failing, so this is what tells a replica that was never copied.
+    The version row is required too: it is only ever created on the
+    primary, see catalog.get_catalog_version().
+    '''
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute('SELECT version FROM catalog_version')
+        rows = cursor.fetchall()
+    finally:
+        cursor.close()
+    if not rows:
+        raise ReplicaUnavailable('no catalog version')
+
+
+class ReplicaSet(object):
+    '''
+    The replica engines of a process, with their health.
+    '''
+
+    def __init__(self, urls, settings=config):
+        '''
+        @param urls: the DB URLs of the replicas
+        @param settings: object holding the settings, see config.py
+        '''
+        self.engines = [make_engine(settings, url) for url in urls]
+        self.retry_after = settings.REPLICA_RETRY_SECONDS
+        self._down_until = {}
+        self._turn = itertools.count()
+        self._lock = threading.Lock()
+        for engine in self.engines:
+            event.listen(engine, 'connect', _check_catalog)
+            event.listen(engine, 'handle_error', self._on_error)
+
+    def __len__(self):
+        return len(self.engines)
+
+    def is_up(self, engine):
+        '''
+        Tell if a replica may be used, i.e. it is not marked down, or its
+        retry time has come.
+
+        @param engine: the replica engine
+        :returns: True if it may be used
+        '''
+        return self._down_until.get(engine, 0) <= time.time()
+
+    def mark_down(self, engine):
+        '''
+        Stop using a replica for a while.
+
+        @param engine: the replica engine
+        '''
+        with self._lock:
+            if not self.is_up(engine):
+                return
+            self._down_until[engine] = time.time() + self.retry_after
+        logger.warning('Replica %s is down, retrying in %ss',
+                       engine.url, self.retry_after)
+
+    def connect(self):
+        '''
+        Connect to the next replica that is up, in turn. A replica that
+        fails to connect is marked down and the next one is tried.
+
+        :returns: the Connection, or None if no replica is up
+        '''
+        count = len(self.engines)
+        start = next(self._turn)
+        for i in range(count):
+            engine = self.engines[(start + i) % count]
+            if not self.is_up(engine):
+                continue
+            try:
+                return engine.connect()
+            except (DBAPIError, engine.dialect.dbapi.Error,
+                    ReplicaUnavailable):
+                self.mark_down(engine)
+        return None
+
+    def health(self):
+        '''
+        :returns: dict of replica URL to whether it is up
+        '''
+        return {str(engine.url): self.is_up(engine)
+                for engine in self.engines}
+
+    def dispose(self):
+        '''
+        Close the pooled connections of every replica engine.
+        '''
+        for engine in self.engines:
+            engine.dispose()
+
+    def _on_error(self, context):
+        if context.is_disconnect and context.engine is not None:
+            self.mark_down(context.engine)
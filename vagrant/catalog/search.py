@@ -0,0 +1,196 @@
+from collections import namedtuple
+from sqlalchemy import and_, or_, asc, text
+from db_setup import Team, Player, POSITIONS
+import difflib
+import re
+
+
+# result count bounds for a search
+SEARCH_LIMIT = 20
+SEARCH_MAX_LIMIT = 100
+# fuzzy matching: how many known terms may stand in for a misspelled
+# one, and how close they must be, see difflib.get_close_matches()
+FUZZY_MATCHES = 3
+FUZZY_CUTOFF = 0.7
+# terms shorter than this are only prefix matched
+FUZZY_MIN_LENGTH = 3
+# column weights for the bm25 ranking: name, position, team
+RANK_WEIGHTS = (10.0, 1.0, 2.0)
+
+_TOKEN = re.compile(r'\w+', re.UNICODE)
+
+# {DB url: has the player_fts table}
+_fts_available = {}
+
+
+class SearchResult(namedtuple('SearchResult', [
+        'id', 'name', 'jersey_number', 'position', 'team_name',
+        'team_nickname'])):
+    '''
+    A player matching a search, with its team.
+    '''
+    __slots__ = ()
+
+    @property
+    def serialize(self):
+        """Return object data in easily serializeable format."""
+        return {
+            'id': self.id,
+            'name': self.name,
+            'jersey_number': self.jersey_number,
+            'position': self.position,
+            'team': {
+                'name': self.team_name,
+                'nickname': self.team_nickname
+            }
+        }
+
+
+def tokenize(query):
+    '''
+    Split a search query into lowercase terms.
+    Punctuation is dropped, which also keeps the FTS5 query syntax out of
+    user input.
+
+    @param query: the search query
+    :returns: list of terms
+    '''
+    return _TOKEN.findall(query.lower())
+
+
+def has_fts(session):
+    '''
+    Tell if the DB has the player_fts index, see migrations.py.
+    Checked once per DB.
+
+    @param session: the DB session to check with
+    :returns: True if the index exists
+    '''
+    # a replica connection, or an engine, see database.RoutingSession
+    bind = session.get_bind()
+    url = str(bind.engine.url)
+    if url not in _fts_available:
+        _fts_available[url] = bind.dialect.name == 'sqlite' and \
+            session.execute(text(
+                "SELECT 1 FROM sqlite_master "
+                "WHERE type = 'table' AND name = 'player_fts'")
+            ).scalar() is not None
+    return _fts_available[url]
+
+
+def search_players(session, query, limit=SEARCH_LIMIT):
+    '''
+    Search players by name, position and team name.
+    Every term of the query must match, as a prefix, a word of one of
+    those. If nothing does, misspelled terms are swapped for the closest
+    terms in the index and the search is run again. Results come back
+    best first, ranked by bm25 with names weighing the most.
+    The index lookups do not scan the roster, so the cost grows with the
+    number of matches rather than with the number of players.
+
+    @param session: the DB session to run the search with
+    @param query: the search query
+    @param limit: the maximum number of results
+    :returns: list of SearchResult
+    '''
+    terms = tokenize(query)
+    if not terms:
+        return []
+    if not has_fts(session):
+        return _like_search(session, terms, limit)
+
+    results = _fts_search(
+        session, [['"{}"*'.format(term)] for term in terms], limit)
+    if results:
+        return results
+
+    alternatives = [_fuzzy_alternatives(session, term) for term in terms]
+    if all(len(alts) == 1 for alts in alternatives):
+        # nothing close enough to any of the terms
+        return []
+    return _fts_search(session, alternatives, limit)
+
+
+def _fts_search(session, alternatives, limit):
+    '''
+    Utility method: run an FTS5 query.
+
+    @param alternatives: list, per query term, of the FTS5 expressions
+        any of which matches the term
+    '''
+    match = ' AND '.join(
+        '(' + ' OR '.join(alts) + ')' for alts in alternatives)
+    rows = session.execute(text(
+        'SELECT player.id, player.name, player.jersey_number, '
+        'player.position, team.name, team.nickname '
+        'FROM (SELECT rowid, bm25(player_fts, {}) AS score '
+        '      FROM player_fts WHERE player_fts MATCH :match '
+        '      ORDER BY score LIMIT :limit) AS hits '
+        'JOIN player ON player.id = hits.rowid '
+        'JOIN team ON team.id = player.team_id '
+        'ORDER BY hits.score, player.id'.format(
+            ', '.join(str(weight) for weight in RANK_WEIGHTS))
+    ).columns(
+        Player.id, Player.name, Player.jersey_number, Player.position,
+        Team.name, Team.nickname
+    ), {'match': match, 'limit': limit})
+    return [SearchResult(*row) for row in rows]
+
+
+def _fuzzy_alternatives(session, term):
+    '''
+    Utility method: the FTS5 expressions matching a term or its closest
+    indexed terms. Only terms sharing its first letter are considered,
+    which keeps the vocabulary lookup to a range of the index.
+
+    :returns: list of FTS5 expressions, the term's own prefix query first
+    '''
+    alternatives = ['"{}"*'.format(term)]
+    if len(term) < FUZZY_MIN_LENGTH:
+        return alternatives
+
+    first = term[0]
+    candidates = [row[0] for row in session.execute(text(
+        'SELECT term FROM player_fts_vocab '
+        'WHERE term >= :low AND term < :high'),
+        {'low': first, 'high': chr(ord(first) + 1)})]
+    for candidate in difflib.get_close_matches(
+            term, candidates, FUZZY_MATCHES, FUZZY_CUTOFF):
+        alternatives.append('"{}"'.format(candidate))
+    return alternatives
+
+
+def _like_search(session, terms, limit):
+    '''
+    Utility method: search without the FTS index, for DBs lacking it.
+    This scans the player table; results come back by name.
+    '''
+    conditions = []
+    for term in terms:
+        pattern = '%{}%'.format(
+            term.replace('\\', '\\\\').replace('%', '\\%')
+            .replace('_', '\\_'))
+        matches = [
+            Player.name.ilike(pattern, escape='\\'),
+            Team.name.ilike(pattern, escape='\\')
+        ]
+        # positions are stored as codes, match their names here
+        positions = [p for p in POSITIONS if term in p.lower()]
+        if positions:
+            matches.append(Player.position.in_(positions))
+        conditions.append(or_(*matches))
+    rows = session.query(
+        Player.id,
+        Player.name,
+        Player.jersey_number,
+        Player.position,
+        Team.name,
+        Team.nickname
+    ).join(
+        Team, Team.id == Player.team_id
+    ).filter(
+        and_(*conditions)
+    ).order_by(
+        asc(Player.name), asc(Player.id)
+    ).limit(limit)
+    return [SearchResult(*row) for row in rows]
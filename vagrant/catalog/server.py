@@ -2,101 +2,478 @@
 
 from flask import Flask, jsonify, render_template, request, redirect
 from flask import jsonify, url_for, flash, make_response
+from flask import Response, stream_with_context, current_app, g
 from flask import session as login_session
-from sqlalchemy import create_engine, asc
-from sqlalchemy.orm import sessionmaker
-from oauth2client.client import flow_from_clientsecrets
+from sqlalchemy import exists, and_
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from sqlalchemy.orm.exc import NoResultFound
 from oauth2client.client import FlowExchangeError
-from db_setup import Base, User, Team, Player
+from db_setup import User, Player, POSITIONS
+from database import db_session
+from team_registry import team_registry
+from page_cache import page_cache
+from catalog import catalog_rows, build_catalog, stream_catalog
+from catalog import catalog_page, CATALOG_PAGE_SIZE
+from catalog import CATALOG_MAX_PAGE_SIZE, ROSTER_PAGE_SIZE
+from catalog import ROSTER_MAX_PAGE_SIZE, roster_page
+from catalog import parse_fields, select_fields
+from catalog import get_catalog_version, bump_catalog_version
+from player_batch import PlayerBatch, BATCH_MAX_OPERATIONS
+from changes import record_change, read_changes, latest_seq
+from changes import acknowledge, compact, ChangesCompacted
+from changes import CHANGES_PAGE_SIZE, CHANGES_MAX_PAGE_SIZE, CLIENT_ID
+from catalog_formats import catalog_records, negotiate_format
+from catalog_formats import FORMATS, WRITERS
+from search import search_players, SEARCH_LIMIT, SEARCH_MAX_LIMIT
+from functools import wraps
+from itertools import groupby
+from google_api import GoogleAPIError
+import assets
+import compression
+import database
+import google_api
+import records
+import metrics
+import config
+import httplib2
 import random
+import signal
 import string
 import bleach
 import traceback
 import json
-import requests
 
 
-CLIENT_ID = json.loads(
-    open('client_secrets.json', 'r').read())['web']['client_id']
 __DEBUG__ = False
 
-app = Flask(__name__)
+# (rule, view function, options) of every route, see route()
+_routes = []
 
-# connect to the DB and get a session factory
-engine = create_engine('sqlite:///roster.db')
-Base.metadata.bind = engine
-DBSession = sessionmaker(bind=engine)
 
+def route(rule, **options):
+    '''
+    Decorator: declare a route, like Flask.route() does. The routes are
+    added to every app built by create_app().
+
+    @param rule: the URL rule
+    @param options: the options of Flask.add_url_rule(), e.g. methods
+    :returns: the decorator
+    '''
+    def decorator(f):
+        _routes.append((rule, f, options))
+        return f
+    return decorator
+
+
+# the Google client secrets are parsed once, by create_app(); after a
+# SIGHUP they are re-read
+try:
+    signal.signal(signal.SIGHUP, google_api.forget_client_secrets)
+except (AttributeError, ValueError):
+    # no SIGHUP on this platform, or not imported from the main thread
+    pass
+
+# time the SQL of the engine, and expose the caches, see metrics.py
+database.on_engine(metrics.instrument_engine)
+metrics.register_collector(
+    metrics.cache_collector('team_registry', team_registry.stats))
+metrics.register_collector(
+    metrics.cache_collector('page_cache', page_cache.stats))
+metrics.register_collector(lambda: [
+    '# HELP catalog_db_pool_checkouts_total DB connections checked out.',
+    '# TYPE catalog_db_pool_checkouts_total counter',
+    'catalog_db_pool_checkouts_total {}'.format(database.pool_checkouts())
+])
+
+
+def create_app(settings=config):
+    '''
+    Build the app.
+    Nothing connects to the DB until the first request, which builds the
+    engine from the settings, see database.get_engine(). So the app can
+    be created before a WSGI server forks its workers, and each worker
+    gets its own connection pool. There is one engine, page cache and
+    Google client per process, so build one app per process.
+
+    @param settings: object holding the settings, see config.py
+    :returns: the Flask app
+    '''
+    app = Flask(__name__)
+    app.secret_key = settings.SECRET_KEY
+    # for the views, see catalog_settings()
+    app.config['CATALOG_SETTINGS'] = settings
+
+    # one DB session per request, see database.init_app()
+    database.configure(settings)
+    database.init_app(app)
+
+    # parse the Google client secrets now, so a bad file fails early
+    google_api.configure(settings)
+    google_api.client_secrets()
+
+    page_cache.configure(settings.PAGE_CACHE_MAX_ENTRIES,
+                         settings.PAGE_CACHE_TTL)
+
+    # time requests and expose /metrics, see metrics.py
+    metrics.init_app(app, settings)
+
+    # fingerprinted static files, see assets.py
+    assets.init_app(app, settings)
+
+    # gzip/brotli responses, see compression.py; registered last, so it
+    # runs first of the after_request hooks and metrics time it
+    compression.init_app(app, settings)
+
+    app.register_error_handler(SQLAlchemyError, handle_db_error)
+    for rule, view, options in _routes:
+        app.add_url_rule(rule, view_func=view, **options)
+
+    return app
 
-class DBError(Exception):
-    def __init__(self, payload=None):
-        Exception.__init__(self)
-        self.message = 'Houston, we have a DB problem...'
-        self.status_code = 500
-        self.payload = payload
 
-    def to_dict(self):
-        rv = {}
-        if __DEBUG__:
-            rv['traceback'] = self.payload or ''
-        rv['message'] = self.message
-        return rv
+def catalog_settings():
+    '''
+    Utility method: the settings the current app was created with.
+
+    :returns: object holding the settings, see config.py
+    '''
+    return current_app.config['CATALOG_SETTINGS']
 
 
-@app.errorhandler(DBError)
 def handle_db_error(error):
     '''
     DB error handler.
+    Roll back the request's session and report the failure.
 
     @param error: the caught error
     :returns: json-formatted error
     '''
-    response = jsonify(error.to_dict())
-    response.status_code = error.status_code
+    db_session.rollback()
+    rv = {}
+    if __DEBUG__:
+        rv['traceback'] = traceback.format_exc()
+    rv['message'] = 'Houston, we have a DB problem...'
+    response = jsonify(rv)
+    response.status_code = 500
+    return response
+
+
+def clean(text):
+    '''
+    Utility method: bleach user input, timing it for the metrics.
+
+    @param text: the text to clean
+    :returns: the cleaned text
+    '''
+    with metrics.timer('bleach'):
+        return bleach.clean(text)
+
+
+def get_team(team_nickname):
+    '''
+    Utility method: look a team up by nickname in the team registry.
+
+    @param team_nickname: the nickname of the team
+    :returns: the team's TeamRecord
+    :raises: NoResultFound if there is no such team
+    '''
+    team = team_registry.by_nickname(db_session, team_nickname)
+    if team is None:
+        raise NoResultFound('No team nicknamed {}.'.format(team_nickname))
+    return team
+
+
+def catalog_conditional(per_user=False, variant=None):
+    '''
+    Decorator: make a read-only route conditional on the catalog version.
+    Responses carry a strong ETag and a Last-Modified header derived from
+    the catalog version. Requests whose If-None-Match (or, failing that,
+    If-Modified-Since) still matches get a 304 before the route runs, so
+    only the catalog_version table is read.
+
+    @param per_user: the rendered output depends on who is logged in, so
+        the user id becomes part of the ETag; a date can not tell users
+        apart, so those responses get no Last-Modified, and
+        If-Modified-Since is ignored
+    @param variant: function naming the representation a request gets,
+        e.g. its format; a non-empty name becomes part of the ETag
+    :returns: the decorator
+    '''
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            # flashed messages are shown once, never revalidate those
+            if '_flashes' in login_session:
+                return f(*args, **kwargs)
+
+            version, updated_at = get_catalog_version(db_session)
+            # the route answers for this version, see cached_page()
+            g.catalog_version = version
+            etag = 'catalog-v{}'.format(version)
+            if per_user:
+                etag += '-u{}'.format(login_session.get('user_id', 0))
+            if variant is not None and variant():
+                etag += '-{}'.format(variant())
+            last_modified = updated_at.replace(microsecond=0)
+
+            if request.if_none_match:
+                # compressed responses carry the ETag with a suffix
+                not_modified = any(
+                    request.if_none_match.contains(e)
+                    for e in compression.etag_variants(etag))
+            elif request.if_modified_since and not per_user:
+                not_modified = last_modified <= \
+                    request.if_modified_since.replace(tzinfo=None)
+            else:
+                not_modified = False
+
+            if not_modified:
+                response = Response(status=304)
+            else:
+                response = make_response(f(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            if not per_user:
+                response.last_modified = last_modified
+            response.cache_control.no_cache = True
+            if per_user:
+                response.vary.add('Cookie')
+            return response
+        return decorated
+    return decorator
+
+
+def cached_page(f):
+    '''
+    Decorator: serve a rendered page from the page cache.
+    Only anonymous GETs with no pending flashed messages are cached, since
+    those are the only pages that render the same for everybody. Pages
+    are cached for the catalog version catalog_conditional() sent in the
+    ETag, so a page cached before a write is never sent as a newer one.
+
+    :returns: the decorated route
+    '''
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        if request.method != 'GET' or 'username' in login_session or \
+                '_flashes' in login_session:
+            return f(*args, **kwargs)
+
+        version = g.get('catalog_version')
+        if version is None:
+            version = get_catalog_version(db_session)[0]
+        key = (f.__name__, kwargs.get('team_nickname'))
+        page, generation = page_cache.get(key, version)
+        if page is None:
+            page = f(*args, **kwargs)
+            page_cache.set(key, page, generation, version)
+        return page
+    return decorated
+
+
+def bad_request(message, status_code=400):
+    '''
+    Utility method: reject an API request.
+
+    @param message: what was wrong with the request
+    @param status_code: the HTTP status code
+    :returns: json-formatted error
+    '''
+    response = jsonify({'message': message})
+    response.status_code = status_code
     return response
 
 
-@app.route('/api/v1/catalog.json')
+def parse_limit(limit, default, maximum):
+    '''
+    Utility method: parse a page size or result limit query argument.
+
+    @param limit: the argument value, or None if it was not passed
+    @param default: the limit to use when it was not passed
+    @param maximum: the largest limit allowed
+    :returns: the limit
+    :raises: ValueError if it is not an integer between 1 and maximum
+    '''
+    try:
+        limit = int(limit) if limit is not None else default
+    except ValueError:
+        limit = 0
+    if not (limit > 0 and limit <= maximum):
+        raise ValueError(
+            'limit must be an integer between 1 and {}.'.format(maximum))
+    return limit
+
+
+def roster_changed(team_id):
+    '''
+    Utility method: drop the cached pages of a team whose roster changed.
+    Call after the change has been committed.
+
+    @param team_id: the id of the team
+    '''
+    team = team_registry.by_id(db_session, team_id)
+    if team is not None:
+        page_cache.invalidate_team(team.nickname)
+
+
+def catalog_format():
+    '''
+    Utility method: the catalog format the request asks for, see
+    catalog_formats.negotiate_format(); '' for JSON, or if the format is
+    not available.
+    '''
+    try:
+        name = negotiate_format(request.args.get('format'),
+                                request.accept_mimetypes)
+    except ValueError:
+        return ''
+    return name if name != 'json' else ''
+
+
+@route('/api/v1/catalog.json')
+@catalog_conditional(variant=catalog_format)
 def get_catalog_json():
     '''
     API endpoint to pretty-list the entire catalog.
+    ?stream=1 streams the catalog as it is read from the DB.
+    ?cursor=...&limit=... returns one keyset-paginated page, along with
+    the cursor for the next one; pass limit alone to get the first page.
+    ?format=msgpack|ndjson|csv, or the matching Accept header, streams
+    the entire catalog in that format instead, see catalog_formats.py.
 
-    :returns: json-formatted catalog
-    :raises: DBError for any DB transaction issues
+    :returns: json-formatted catalog, or the catalog in the format asked
     '''
-    session = DBSession()
     try:
-        teams = session.query(Team).all()
-        players = session.query(Player).all()
-    except:
-        session.rollback()
-        raise DBError(payload=traceback.format_exc())
-    finally:
-        session.close()
-
-    response = {'teams': []}
-    for team in teams:
-        t_players = [pl for pl in players if pl.team_id == team.id]
-        response['teams'].append(
-            {
-                'id': team.id,
-                'name': team.name,
-                'nickname': team.nickname,
-                'players': [
-                    {
-                        'id': player.id,
-                        'name': player.name,
-                        'jersery_number': player.jersey_number,
-                        'position': player.position
-                    } for player in t_players
-                ]
-            }
+        name = negotiate_format(request.args.get('format'),
+                                request.accept_mimetypes)
+    except ValueError as e:
+        return bad_request(str(e))
+    cursor = request.args.get('cursor')
+    limit = request.args.get('limit')
+    if name != 'json':
+        if cursor is not None or limit is not None:
+            return bad_request('Pages are only available as JSON.')
+        response = Response(
+            stream_with_context(WRITERS[name](catalog_records(db_session))),
+            mimetype=FORMATS[name]
         )
+        if name == 'csv':
+            response.headers['Content-Disposition'] = \
+                'attachment; filename=catalog.csv'
+    elif request.args.get('stream'):
+        rows = catalog_rows(db_session, stream=True)
+        response = Response(
+            stream_with_context(stream_catalog(rows)),
+            mimetype='application/json'
+        )
+    elif cursor is not None or limit is not None:
+        response = get_catalog_page(cursor, limit)
+    else:
+        response = jsonify(build_catalog(catalog_rows(db_session)))
+
+    # the format may come from the Accept header
+    response.vary.add('Accept')
+    return response
+
+
+def get_catalog_page(cursor, limit):
+    '''
+    Utility method: render one page of the catalog.
+
+    @param cursor: the opaque cursor from the previous page, or None
+    @param limit: the requested page size, or None for the default
+    :returns: json-formatted catalog page
+    '''
+    try:
+        limit = parse_limit(limit, CATALOG_PAGE_SIZE, CATALOG_MAX_PAGE_SIZE)
+        page = catalog_page(db_session, cursor, limit)
+    except ValueError as e:
+        return bad_request(str(e))
 
-    return jsonify(response)
+    return jsonify(page)
+
+
+@route('/api/v1/teams/<string:team_nickname>/players')
+@catalog_conditional()
+def get_team_players_json(team_nickname):
+    '''
+    API endpoint to list a team's players, by player id.
+    ?after_id=...&limit=... returns the page of players following the
+    player with that id; next_after_id holds the value for the next page.
+    ?fields=name,jersey_number returns only those player fields.
 
+    @param team_nickname: the nickname of the team to list players for
+    :returns: json-formatted team and page of players
+    '''
+    team = team_registry.by_nickname(db_session, team_nickname)
+    if team is None:
+        return bad_request(
+            'No team nicknamed {}.'.format(team_nickname), 404)
+
+    try:
+        after_id = int(request.args.get('after_id', 0))
+    except ValueError:
+        return bad_request('after_id must be a player id.')
+    try:
+        limit = parse_limit(request.args.get('limit'),
+                            ROSTER_PAGE_SIZE, ROSTER_MAX_PAGE_SIZE)
+        fields = parse_fields(request.args.get('fields'))
+    except ValueError as e:
+        return bad_request(str(e))
 
-@app.route('/login')
+    page = roster_page(db_session, team.id, after_id, limit, fields)
+    page['team'] = team.serialize
+    return jsonify(page)
+
+
+@route('/api/v1/players/<int:player_id>')
+@catalog_conditional()
+def get_player_json(player_id):
+    '''
+    API endpoint to show a player.
+    ?fields=name,jersey_number returns only those fields.
+
+    @param player_id: the id of the player to show
+    :returns: json-formatted player
+    '''
+    try:
+        fields = parse_fields(request.args.get('fields'))
+    except ValueError as e:
+        return bad_request(str(e))
+
+    player = records.player(db_session, player_id)
+    if player is None:
+        return bad_request('No player with id {}.'.format(player_id), 404)
+
+    return jsonify(select_fields(player.serialize, fields))
+
+
+@route('/api/v1/search')
+@catalog_conditional()
+def get_search_json():
+    '''
+    API endpoint to search players by name, position and team name.
+    ?q=... is the query, ?limit=... caps the number of results.
+    Terms match word prefixes, misspelled ones fuzzily; see search.py.
+
+    :returns: json-formatted results, best match first
+    '''
+    query = request.args.get('q', '')
+    try:
+        limit = parse_limit(request.args.get('limit'),
+                            SEARCH_LIMIT, SEARCH_MAX_LIMIT)
+    except ValueError as e:
+        return bad_request(str(e))
+
+    results = search_players(db_session, query, limit)
+    return jsonify({
+        'query': query,
+        'results': [r.serialize for r in results]
+    })
+
+
+@route('/login')
 def show_login():
     '''
     show login route
@@ -107,27 +484,25 @@ def show_login():
     state = ''.join(random.choice(string.ascii_uppercase + string.digits)
                     for x in range(32))
     login_session['state'] = state
-    return render_template('login.html', STATE=state, CLIENT_ID=CLIENT_ID)
+    return render_template(
+        'login.html',
+        STATE=state,
+        CLIENT_ID=google_api.client_secrets().client_id
+    )
 
 
-@app.route('/')
-@app.route('/teams/')
+@route('/')
+@route('/teams/')
+@catalog_conditional(per_user=True)
+@cached_page
 def show_teams():
     '''
     show teams route
     Render the list of teams in the DB.
 
     :returns: render template
-    :raises: DBError for any DB transaction issues
     '''
-    session = DBSession()
-    try:
-        teams = session.query(Team).order_by(asc(Team.name))
-    except:
-        session.rollback()
-        raise DBError(payload=traceback.format_exc())
-    finally:
-        session.close()
+    teams = records.teams(db_session)
 
     return render_template(
         'teams.html',
@@ -136,8 +511,10 @@ def show_teams():
     )
 
 
-@app.route('/teams/<string:team_nickname>/')
-@app.route('/teams/<string:team_nickname>/players/')
+@route('/teams/<string:team_nickname>/')
+@route('/teams/<string:team_nickname>/players/')
+@catalog_conditional(per_user=True)
+@cached_page
 def show_players(team_nickname):
     '''
     show players route
@@ -145,29 +522,23 @@ def show_players(team_nickname):
 
     @param team_nickname: the nickname of the team to list players for
     :returns: render template
-    :raises: DBError for any DB transaction issues
     '''
-    session = DBSession()
-    try:
-        team = session.query(Team).filter_by(nickname=team_nickname).one()
-        items = session.query(Player).filter_by(
-            team_id=team.id).all()
-    except:
-        session.rollback()
-        raise DBError(payload=traceback.format_exc())
-    finally:
-        session.close()
+    team = get_team(team_nickname)
+    items = records.roster(db_session, team.id)
+    groups = dict((position, list(players)) for position, players in
+                  groupby(items, lambda p: p.position))
 
     return render_template(
         'players.html',
-        items=items,
+        groups=[(position, groups.get(position, []))
+                for position in POSITIONS],
         team=team,
         login_session=login_session
     )
 
 
-@app.route('/teams/<string:team_nickname>/<int:player_id>')
-@app.route('/teams/<string:team_nickname>/players/<int:player_id>')
+@route('/teams/<string:team_nickname>/<int:player_id>')
+@route('/teams/<string:team_nickname>/players/<int:player_id>')
 def show_player(team_nickname, player_id):
     '''
     show player route
@@ -176,16 +547,10 @@ def show_player(team_nickname, player_id):
 
     @param player_id: the id of the player to show
     :returns: render template
-    :raises: DBError for any DB transaction issues
     '''
-    session = DBSession()
-    try:
-        player = session.query(Player).filter_by(id=player_id).one()
-    except:
-        session.rollback()
-        raise DBError(payload=traceback.format_exc())
-    finally:
-        session.close()
+    player = records.player(db_session, player_id)
+    if player is None:
+        raise NoResultFound('No player with id {}.'.format(player_id))
 
     return render_template(
         'player.html',
@@ -195,23 +560,47 @@ def show_player(team_nickname, player_id):
     )
 
 
-def is_jersey_number_valid(form_data, team_id):
+@route('/search')
+@catalog_conditional(per_user=True)
+def show_search():
+    '''
+    show search route
+    Render the players matching the ?q=... query.
+
+    :returns: render template
+    '''
+    query = request.args.get('q', '')
+    results = search_players(db_session, query)
+
+    return render_template(
+        'search.html',
+        query=query,
+        results=results,
+        login_session=login_session
+    )
+
+
+def is_jersey_number_valid(form_data, team_id, player_id=None):
     '''
     Utility method: jersey number validator.
+    The availability check is a single probe of the team/jersey index.
+    It can still race with a concurrent write; the unique index has the
+    final say at commit time, see is_jersey_conflict().
 
     @param form_data: the data collected from the user-submitted form
     @param team_id: the id of the team to check for unique jersey number
+    @param player_id: the id of the player being edited, whose own
+        jersey number does not count as taken
     :returns: (bool, int) tuple, where
         bool - signifies the jersey_number is either valid or invalid
         int - the jersey_number, if it is valid or already taken OR
               a numeric code if it is invalid
-    :raises: DBError for any DB transaction issues
     '''
 
     # is integer
     try:
         jersey_number = int(
-            bleach.clean(form_data['jersey_number'])
+            clean(form_data['jersey_number'])
         )
     except ValueError:
         return (False, 1)
@@ -221,25 +610,60 @@ def is_jersey_number_valid(form_data, team_id):
         return (False, 2)
 
     # is not already taken
-    session = DBSession()
-    try:
-        players = session.query(Player).filter_by(team_id=team_id).all()
-    except:
-        session.rollback()
-        raise DBError(payload=traceback.format_exc())
-    finally:
-        session.close()
-
-    if jersey_number in [
-        item.jersey_number for item in players
-    ]:
+    taken = db_session.query(exists().where(and_(
+        Player.team_id == team_id,
+        Player.jersey_number == jersey_number,
+        Player.id != player_id
+    ))).scalar()
+    if taken:
         return (False, jersey_number)
 
     return (True, jersey_number)
 
 
-@app.route('/teams/<string:team_nickname>/new/', methods=['GET', 'POST'])
-@app.route('/teams/<string:team_nickname>/players/new/', methods=[
+def is_jersey_conflict(error):
+    '''
+    Utility method: tell if a failed commit lost a jersey number race.
+
+    @param error: the IntegrityError raised by the commit
+    :returns: True if the team/jersey unique index was violated
+    '''
+    message = str(error.orig)
+    return 'ix_player_team_jersey' in message or \
+        'player.jersey_number' in message
+
+
+def is_position_valid(form_data):
+    '''
+    Utility method: position validator.
+
+    @param form_data: the data collected from the user-submitted form
+    :returns: True if the position is one of POSITIONS
+    '''
+    return form_data.get('position') in POSITIONS
+
+
+def flash_invalid_position():
+    '''
+    Utility method: complain about a position that is not one of ours.
+    '''
+    flash('Position must be one of {}.'.format(', '.join(POSITIONS)))
+
+
+def flash_jersey_taken(jersey_number):
+    '''
+    Utility method: complain about a jersey number that is already taken.
+
+    @param jersey_number: the taken jersey number
+    '''
+    flash(
+        'Jersey number {} is already taken! \
+        Please try a different one.'.format(str(jersey_number))
+    )
+
+
+@route('/teams/<string:team_nickname>/new/', methods=['GET', 'POST'])
+@route('/teams/<string:team_nickname>/players/new/', methods=[
     'GET', 'POST'])
 def add_player(team_nickname):
     '''
@@ -249,19 +673,11 @@ def add_player(team_nickname):
 
     @param team_nickname: the nickname of the team to list players for
     :returns: render template
-    :raises: DBError for any DB transaction issues
     '''
     if 'username' not in login_session:
         return redirect('/login')
 
-    session = DBSession()
-    try:
-        team = session.query(Team).filter_by(nickname=team_nickname).one()
-    except:
-        session.rollback()
-        raise DBError(payload=traceback.format_exc())
-    finally:
-        session.close()
+    team = get_team(team_nickname)
 
     if request.method == 'POST':
         jersey_validity = is_jersey_number_valid(request.form, team.id)
@@ -275,17 +691,14 @@ def add_player(team_nickname):
                 team_nickname=team_nickname
             )
         else:
-            flash(
-                'Jersey number {} is already taken! \
-                Please try a different one.'.format(str(jersey_validity[1]))
-            )
+            flash_jersey_taken(jersey_validity[1])
             return render_template(
                 'new-player.html',
                 team_nickname=team_nickname
             )
 
         # validate new player name isn't empty
-        name = bleach.clean(request.form['name'])
+        name = clean(request.form['name'])
         if name == '':
             flash(
                 'Player name can not be empty! Please name this person.'
@@ -295,25 +708,38 @@ def add_player(team_nickname):
                 team_nickname=team_nickname
             )
 
-        # compile new player data
-        new_player = Player(
+        if not is_position_valid(request.form):
+            flash_invalid_position()
+            return render_template(
+                'new-player.html',
+                team_nickname=team_nickname
+            )
+
+        # add player to the DB
+        player = Player(
             name=name,
-            position=bleach.clean(request.form['position']),
+            position=request.form['position'],
             jersey_number=jersey_number,
             team_id=team.id,
             user_id=login_session['user_id']
         )
-
-        session = DBSession()
+        bump_catalog_version(db_session)
         try:
-            # add player to the DB
-            session.add(new_player)
-            session.commit()
-        except:
-            session.rollback()
-            raise DBError(payload=traceback.format_exc())
-        finally:
-            session.close()
+            db_session.add(player)
+            db_session.flush()
+            record_change(db_session, 'create', player)
+            db_session.commit()
+        except IntegrityError as e:
+            if not is_jersey_conflict(e):
+                raise
+            # somebody else grabbed the number in the meantime
+            db_session.rollback()
+            flash_jersey_taken(jersey_number)
+            return render_template(
+                'new-player.html',
+                team_nickname=team_nickname
+            )
+        roster_changed(team.id)
 
         flash('Player added.')
         return redirect(url_for(
@@ -327,10 +753,10 @@ def add_player(team_nickname):
         )
 
 
-@app.route('/teams/<string:team_nickname>/<int:player_id>/edit',
-           methods=['GET', 'POST'])
-@app.route('/teams/<string:team_nickname>/players/<int:player_id>/edit',
-           methods=['GET', 'POST'])
+@route('/teams/<string:team_nickname>/<int:player_id>/edit',
+       methods=['GET', 'POST'])
+@route('/teams/<string:team_nickname>/players/<int:player_id>/edit',
+       methods=['GET', 'POST'])
 def edit_player(team_nickname, player_id):
     '''
     edit player route.
@@ -340,19 +766,11 @@ def edit_player(team_nickname, player_id):
     @param team_nickname: the nickname of the team to list players for
     @param player_id: the id of the player to be edited
     :returns: render template
-    :raises: DBError for any DB transaction issues
     '''
     if 'username' not in login_session:
         return redirect('/login')
 
-    session = DBSession()
-    try:
-        editedPlayer = session.query(Player).filter_by(id=player_id).one()
-    except:
-        session.rollback()
-        raise DBError(payload=traceback.format_exc())
-    finally:
-        session.close()
+    editedPlayer = db_session.query(Player).filter_by(id=player_id).one()
 
     if editedPlayer.user_id != login_session['user_id']:
             flash('You are not authorized to edit this player!')
@@ -365,13 +783,10 @@ def edit_player(team_nickname, player_id):
 
     if request.method == 'POST':
         jersey_validity = is_jersey_number_valid(
-            request.form, editedPlayer.team_id
+            request.form, editedPlayer.team_id, player_id
         )
-        # good new jersey number, keep it
-        if jersey_validity[0]:
-            editedPlayer.jersey_number = jersey_validity[1]
         # bad jersey number format or lenght or something, complain
-        elif jersey_validity[1] in [1, 2]:
+        if not jersey_validity[0] and jersey_validity[1] in [1, 2]:
             flash('Jersey number must be an integer \
                 between 1 and 99.')
             return render_template(
@@ -380,29 +795,18 @@ def edit_player(team_nickname, player_id):
                 player_id=player_id,
                 item=editedPlayer
             )
-        # jersey number already taken
-        else:
-            jersey_number = jersey_validity[1]
-            # taken by somebody else, complain
-            if editedPlayer.jersey_number != jersey_number:
-                flash(
-                    'Jersey number {} is already taken! \
-                    Please try a different one.'.format(
-                        str(jersey_number)
-                    )
-                )
-                return render_template(
-                    'edit-player.html',
-                    team_nickname=team_nickname,
-                    player_id=player_id,
-                    item=editedPlayer
-                )
-            # taken by the same player, keep it
-            else:
-                editedPlayer.jersey_number = jersey_number
+        # taken by somebody else, complain
+        elif not jersey_validity[0]:
+            flash_jersey_taken(jersey_validity[1])
+            return render_template(
+                'edit-player.html',
+                team_nickname=team_nickname,
+                player_id=player_id,
+                item=editedPlayer
+            )
 
         # validate new player name isn't empty
-        name = bleach.clean(request.form['name'])
+        name = clean(request.form['name'])
         if name == '':
             flash(
                 'Player name can not be empty! Please name this person.'
@@ -413,20 +817,41 @@ def edit_player(team_nickname, player_id):
                 player_id=player_id,
                 item=editedPlayer
             )
-        editedPlayer.name = name
 
-        if request.form['position']:
-            editedPlayer.position = bleach.clean(request.form['position'])
+        # no position keeps the player's own
+        if request.form.get('position') and \
+                not is_position_valid(request.form):
+            flash_invalid_position()
+            return render_template(
+                'edit-player.html',
+                team_nickname=team_nickname,
+                player_id=player_id,
+                item=editedPlayer
+            )
 
-        session = DBSession()
+        # good new jersey number, or the player's own, keep it
+        team_id = editedPlayer.team_id
+        editedPlayer.jersey_number = jersey_validity[1]
+        editedPlayer.name = name
+        if request.form.get('position'):
+            editedPlayer.position = request.form['position']
         try:
-            session.add(editedPlayer)
-            session.commit()
-        except:
-            session.rollback()
-            raise DBError(payload=traceback.format_exc())
-        finally:
-            session.close()
+            # both flush the edited player, so they can lose the race too
+            bump_catalog_version(db_session)
+            record_change(db_session, 'update', editedPlayer)
+            db_session.commit()
+        except IntegrityError as e:
+            if not is_jersey_conflict(e):
+                raise
+            # somebody else grabbed the number in the meantime
+            db_session.rollback()
+            flash_jersey_taken(jersey_validity[1])
+            return redirect(url_for(
+                'edit_player',
+                team_nickname=team_nickname,
+                player_id=player_id)
+            )
+        roster_changed(team_id)
 
         flash('Player edited.')
         return redirect(url_for(
@@ -442,10 +867,10 @@ def edit_player(team_nickname, player_id):
         )
 
 
-@app.route('/teams/<string:team_nickname>/<int:player_id>/delete/',
-           methods=['GET', 'POST'])
-@app.route('/teams/<string:team_nickname>/players/<int:player_id>/delete/',
-           methods=['GET', 'POST'])
+@route('/teams/<string:team_nickname>/<int:player_id>/delete/',
+       methods=['GET', 'POST'])
+@route('/teams/<string:team_nickname>/players/<int:player_id>/delete/',
+       methods=['GET', 'POST'])
 def delete_player(team_nickname, player_id):
     '''
     delete player route.
@@ -455,19 +880,11 @@ def delete_player(team_nickname, player_id):
     @param team_nickname: the nickname of the team to list players for
     @param player_id: the id of the player to be deleted
     :returns: render template
-    :raises: DBError for any DB transaction issues
     '''
     if 'username' not in login_session:
         return redirect('/login')
 
-    session = DBSession()
-    try:
-        itemToDelete = session.query(Player).filter_by(id=player_id).one()
-    except:
-        session.rollback()
-        raise DBError(payload=traceback.format_exc())
-    finally:
-        session.close()
+    itemToDelete = db_session.query(Player).filter_by(id=player_id).one()
 
     if itemToDelete.user_id != login_session['user_id']:
             flash('You are not authorized to delete this player!')
@@ -479,15 +896,12 @@ def delete_player(team_nickname, player_id):
             )
 
     if request.method == 'POST':
-        session = DBSession()
-        try:
-            session.delete(itemToDelete)
-            session.commit()
-        except:
-            session.rollback()
-            raise DBError(payload=traceback.format_exc())
-        finally:
-            session.close()
+        team_id = itemToDelete.team_id
+        bump_catalog_version(db_session)
+        record_change(db_session, 'delete', itemToDelete)
+        db_session.delete(itemToDelete)
+        db_session.commit()
+        roster_changed(team_id)
 
         flash('Player deleted.')
         return redirect(url_for(
@@ -502,29 +916,133 @@ def delete_player(team_nickname, player_id):
         )
 
 
+@route('/api/v1/players/batch', methods=['POST'])
+def batch_players():
+    '''
+    API endpoint to create, update and delete players in one go.
+    The body is {"operations": [...]}, see player_batch.py. Either every
+    operation is applied, in one transaction, or none is.
+
+    :returns: json-formatted per-operation results; on a 400 the results
+        list the rejected operations
+    '''
+    if 'username' not in login_session:
+        return bad_request('Login required.', 401)
+
+    body = request.get_json(silent=True)
+    operations = body.get('operations') if isinstance(body, dict) else None
+    if not isinstance(operations, list) or not operations or \
+            len(operations) > BATCH_MAX_OPERATIONS:
+        return bad_request('operations must be a list of 1 to {} '
+                           'operations.'.format(BATCH_MAX_OPERATIONS))
+
+    batch = PlayerBatch(db_session, login_session['user_id'], clean=clean)
+    errors = batch.validate(operations)
+    if errors:
+        response = jsonify({
+            'message': 'No operation was applied.',
+            'results': [{'index': index, 'status': 'rejected',
+                         'message': message} for index, message in errors]
+        })
+        response.status_code = 400
+        return response
+
+    try:
+        # apply() runs the statements right away, so it can lose the race
+        results = batch.apply()
+        db_session.commit()
+    except IntegrityError as e:
+        if not is_jersey_conflict(e):
+            raise
+        # somebody else grabbed a number in the meantime
+        db_session.rollback()
+        return bad_request('A jersey number was taken by a concurrent '
+                           'change; no operation was applied.', 409)
+    for team_id in batch.team_ids:
+        roster_changed(team_id)
+
+    return jsonify({'results': results})
+
+
+@route('/api/v1/changes')
+def get_changes_json():
+    '''
+    API endpoint to follow the player changes, see changes.py.
+    ?since=<seq> returns the changes after that sequence number, oldest
+    first, at most ?limit=... of them; pass next_since back as since for
+    the next ones. Deletes come as tombstones, with no player.
+    Without since, only latest_seq is returned: the point to follow the
+    changes from after downloading the catalog.
+    ?client=<id> records that the client has every change up to since,
+    so they can be compacted away once every client has them. A since
+    that was compacted away gets a 410; download the catalog again.
+
+    :returns: json-formatted changes
+    '''
+    # the feed must not lag behind the catalog, and it writes the cursor
+    database.use_primary()
+
+    client_id = request.args.get('client')
+    if client_id is not None and not CLIENT_ID.match(client_id):
+        return bad_request('client must be 1 to 64 letters, digits, '
+                           'dots, dashes or underscores.')
+    try:
+        limit = parse_limit(request.args.get('limit'),
+                            CHANGES_PAGE_SIZE, CHANGES_MAX_PAGE_SIZE)
+    except ValueError as e:
+        return bad_request(str(e))
+    since = request.args.get('since')
+    if since is not None:
+        try:
+            since = int(since)
+        except ValueError:
+            return bad_request('since must be a sequence number.')
+
+    latest = latest_seq(db_session)
+    if since is None:
+        return jsonify({'changes': [], 'next_since': latest,
+                        'latest_seq': latest})
+    if since < 0 or since > latest:
+        return bad_request('since must be between 0 and {}.'.format(latest))
+
+    try:
+        changes = read_changes(db_session, since, limit)
+    except ChangesCompacted as e:
+        return bad_request(
+            'Changes up to {} were compacted away; download the catalog '
+            'again.'.format(e.floor), 410)
+
+    if client_id is not None:
+        acknowledge(db_session, client_id, since)
+        compact(db_session, catalog_settings())
+        try:
+            db_session.commit()
+        except IntegrityError:
+            # a concurrent request of the same client, or compaction, won
+            db_session.rollback()
+
+    next_since = changes[-1].seq if changes else since
+    return jsonify({
+        'changes': [change.serialize for change in changes],
+        'next_since': next_since,
+        'latest_seq': max(latest, next_since)
+    })
+
+
 def create_user(login_session):
     '''
     create a new user
 
     @param login_session: an instance of login_session
     :returns: the creaded user's id
-    :raises: DBError for any DB transaction issues
     '''
-    session = DBSession()
-    try:
-        session.add(User(
-            name=login_session['username'],
-            email=login_session['email']
-        ))
-        session.commit()
-        user = session.query(User).filter_by(
-            email=login_session['email']
-        ).one()
-    except:
-        session.rollback()
-        raise DBError(payload=traceback.format_exc())
-    finally:
-        session.close()
+    user = User(
+        name=login_session['username'],
+        email=login_session['email']
+    )
+    db_session.add(user)
+    bump_catalog_version(db_session)
+    db_session.commit()
 
     return user.id
 
@@ -535,17 +1053,8 @@ def get_user_info(user_id):
 
     @param user_id: the user_id
     :returns: the db row entry
-    :raises: DBError for any DB transaction issues
     '''
-    session = DBSession()
-    try:
-        user = session.query(User).filter_by(id=user_id).one()
-    except:
-        raise DBError(payload=traceback.format_exc())
-    finally:
-        session.close()
-
-    return user
+    return db_session.query(User).filter_by(id=user_id).one()
 
 
 def get_user_id(email):
@@ -554,20 +1063,26 @@ def get_user_id(email):
 
     @param email: the user email address
     :returns: user.id or None
-    :raises: DBError for any DB transaction issues
     '''
-    session = DBSession()
-    try:
-        user = session.query(User).filter_by(email=email).one_or_none()
-    except:
-        raise DBError(payload=traceback.format_exc())
-    finally:
-        session.close()
+    user = db_session.query(User).filter_by(email=email).one_or_none()
 
     return user.id if user is not None else None
 
 
-@app.route('/gconnect', methods=['POST'])
+def google_unavailable():
+    '''
+    Utility method: report that a Google round-trip failed.
+
+    :returns: json-formatted 502 response
+    '''
+    current_app.logger.warning('Google sign-in round-trip failed.',
+                               exc_info=True)
+    response = make_response(json.dumps('Failed to reach Google.'), 502)
+    response.headers['Content-Type'] = 'application/json'
+    return response
+
+
+@route('/gconnect', methods=['POST'])
 def gconnect():
     '''
     handle ajax call to log user in with Google
@@ -583,20 +1098,24 @@ def gconnect():
 
     try:
         # Upgrade the authorization code into a credentials object
-        oauth_flow = flow_from_clientsecrets('client_secrets.json', scope='')
-        oauth_flow.redirect_uri = 'postmessage'
-        credentials = oauth_flow.step2_exchange(code)
+        client = google_api.client_secrets()
+        oauth_flow = client.flow(scope='', redirect_uri='postmessage')
+        credentials = oauth_flow.step2_exchange(
+            code, http=google_api.exchange_http())
     except FlowExchangeError:
         response = make_response(
             json.dumps('Failed to upgrade the authorization code.'), 401)
         response.headers['Content-Type'] = 'application/json'
         return response
+    except (httplib2.HttpLib2Error, OSError):
+        return google_unavailable()
 
     # Check that the access token is valid.
     access_token = credentials.access_token
-    url = ('https://www.googleapis.com/oauth2/v1/tokeninfo?access_token=%s'
-           % access_token)
-    result = requests.get(url).json()
+    try:
+        result = google_api.get_token_info(access_token)
+    except GoogleAPIError:
+        return google_unavailable()
 
     # If there was an error in the access token info, abort.
     if result.get('error') is not None:
@@ -605,7 +1124,7 @@ def gconnect():
         return response
 
     # Verify that the access token is valid for this app.
-    if result['issued_to'] != CLIENT_ID:
+    if result['issued_to'] != client.client_id:
         response = make_response(
             json.dumps("Token's client ID does not match app's."), 401)
         response.headers['Content-Type'] = 'application/json'
@@ -614,9 +1133,10 @@ def gconnect():
     # Store the access token in the session for later use.
     login_session['access_token'] = credentials.access_token
 
-    userinfo_url = "https://www.googleapis.com/oauth2/v1/userinfo"
-    params = {'access_token': credentials.access_token, 'alt': 'json'}
-    data = requests.get(userinfo_url, params=params).json()
+    try:
+        data = google_api.get_user_info(credentials.access_token)
+    except GoogleAPIError:
+        return google_unavailable()
     login_session['username'] = data['name']
     login_session['email'] = data['email']
 
@@ -635,7 +1155,7 @@ def gconnect():
     return output
 
 
-@app.route('/disconnect')
+@route('/disconnect')
 def disconnect():
     '''
     log Google user out
@@ -646,12 +1166,12 @@ def disconnect():
     if access_token is None or login_session.get('username') is None:
         return redirect(url_for('show_teams'))
 
-    # Invalidate access token
-    requests.post(
-        'https://accounts.google.com/o/oauth2/revoke',
-        params={'token': access_token},
-        headers={'content-type': 'application/x-www-form-urlencoded'}
-    )
+    # Invalidate access token; log out locally even if Google is down
+    try:
+        google_api.revoke_token(access_token)
+    except GoogleAPIError:
+        current_app.logger.warning('Could not revoke the access token.',
+                                   exc_info=True)
 
     del login_session['user_id']
     del login_session['username']
@@ -662,6 +1182,11 @@ def disconnect():
 
 
 if __name__ == '__main__':
-    app.secret_key = 'super_secret_key'
+    # the development server; see wsgi.py for production. Nothing else
+    # builds an app at import time, so a process gets just one
+    app = create_app()
+    database.create_schema()
+    if not app.secret_key:
+        app.secret_key = 'super_secret_key'
     app.debug = __DEBUG__
     app.run(host='0.0.0.0', port=8000)
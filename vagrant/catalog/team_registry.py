@@ -0,0 +1,106 @@
+from sqlalchemy import event, select
+from db_setup import Team
+from records import TeamRecord, TEAM_COLUMNS, team_table
+import records
+import threading
+
+
+class TeamRegistry(object):
+    '''
+    Process-local registry of the teams, keyed by nickname and by id.
+    The teams table is effectively static, so it is read once and served
+    from memory. A lookup that misses goes to the DB, so teams added by
+    another process are still found. Call invalidate() after changing
+    teams; changes made through this process's ORM do it automatically.
+    '''
+
+    def __init__(self):
+        self._by_nickname = None
+        self._by_id = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, session):
+        '''
+        (Re)load every team from the DB.
+
+        @param session: the DB session to run the query with
+        '''
+        teams = records.teams(session)
+        with self._lock:
+            self._by_nickname = dict((t.nickname, t) for t in teams)
+            self._by_id = dict((t.id, t) for t in teams)
+
+    def invalidate(self):
+        '''
+        Drop the loaded teams; the next lookup reloads them.
+        '''
+        with self._lock:
+            self._by_nickname = None
+            self._by_id = None
+
+    def by_nickname(self, session, nickname):
+        '''
+        Look a team up by its nickname.
+
+        @param session: the DB session to use on a miss
+        @param nickname: the team nickname
+        :returns: the TeamRecord, or None if there is no such team
+        '''
+        return self._lookup(session, 'nickname', nickname)
+
+    def by_id(self, session, team_id):
+        '''
+        Look a team up by its id.
+
+        @param session: the DB session to use on a miss
+        @param team_id: the team id
+        :returns: the TeamRecord, or None if there is no such team
+        '''
+        return self._lookup(session, 'id', team_id)
+
+    def stats(self):
+        '''
+        :returns: dict with the hit and miss counts and the registry size
+        '''
+        by_id = self._by_id
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(by_id) if by_id is not None else 0
+        }
+
+    def _lookup(self, session, key, value):
+        index = self._by_id if key == 'id' else self._by_nickname
+        if index is None:
+            self.load(session)
+            index = self._by_id if key == 'id' else self._by_nickname
+
+        team = index.get(value)
+        with self._lock:
+            if team is not None:
+                self.hits += 1
+                return team
+            self.misses += 1
+
+        row = session.execute(select(TEAM_COLUMNS).where(
+            getattr(team_table.c, key) == value)).first()
+        if row is None:
+            return None
+        team = TeamRecord(*row)
+        with self._lock:
+            if self._by_id is not None:
+                self._by_id[team.id] = team
+                self._by_nickname[team.nickname] = team
+        return team
+
+
+team_registry = TeamRegistry()
+
+
+@event.listens_for(Team, 'after_insert')
+@event.listens_for(Team, 'after_update')
+@event.listens_for(Team, 'after_delete')
+def _invalidate_team_registry(mapper, connection, target):
+    team_registry.invalidate()
@@ -0,0 +1,20 @@
+'''
+WSGI entry point. Serve the app with a production WSGI server, e.g.
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+The session cookie key must be set, and be the same for every worker:
+export CATALOG_SECRET_KEY first.
+
+The workers do not touch the DB schema. gunicorn brings it up to date
+before starting them, see gunicorn.conf.py; with another server, run
+python3 migrations.py first.
+'''
+from server import create_app
+import config
+
+
+if not config.SECRET_KEY:
+    raise RuntimeError('Set CATALOG_SECRET_KEY to serve the app.')
+
+app = create_app(config)